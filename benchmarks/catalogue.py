@@ -0,0 +1,68 @@
+# coding: utf-8
+'''
+Synthetic FSO metadata for the benchmarks
+'''
+
+from lxml import etree
+
+LANGUAGES = ['de', 'fr', 'it', 'en']
+GROUPS = ['01', '17', '00', '14']
+XML_LANG = '{http://www.w3.org/XML/1998/namespace}lang'
+
+
+def make_package(index, languages=LANGUAGES, resource_url=None,
+                 resources=1, base_url=u'http://localhost/'):
+    '''
+    Return a <package> element with one dataset per language and the
+    given number of resources per dataset
+    '''
+    package = etree.Element('package')
+    for lang in languages:
+        dataset = etree.SubElement(package, 'dataset')
+        dataset.set('datasetID', 'px-%05d-%s' % (index, lang))
+        dataset.set(XML_LANG, lang)
+        for field in ['title', 'author', 'maintainer', 'notes']:
+            etree.SubElement(dataset, field).text = (
+                u'%s %d (%s)' % (field, index, lang)
+            )
+        etree.SubElement(dataset, 'maintainer_email').text = (
+            u'info@bfs.admin.ch'
+        )
+        etree.SubElement(dataset, 'coverage').text = u'1990-2012'
+        etree.SubElement(dataset, 'published').text = u'01.01.2013'
+        etree.SubElement(dataset, 'licence').text = (
+            u'http://www.bfs.admin.ch/bfs/portal/de/index/'
+            u'footer/04.html'
+        )
+        etree.SubElement(dataset, 'copyright').text = u'cc-zero'
+        groups = etree.SubElement(dataset, 'groups')
+        etree.SubElement(groups, 'group').text = (
+            GROUPS[index % len(GROUPS)] + u'.01'
+        )
+        tags = etree.SubElement(dataset, 'tags')
+        etree.SubElement(tags, 'tag').text = u'tag-%d' % (index % 50)
+        for number in range(resources):
+            file_name = u'px-%05d-%s-%d.csv' % (index, lang, number)
+            resource = etree.SubElement(dataset, 'resource')
+            etree.SubElement(resource, 'name').text = file_name
+            etree.SubElement(resource, 'url').text = (
+                resource_url or base_url + file_name
+            )
+    return package
+
+
+def make_catalogue(packages, languages=LANGUAGES, resources=1,
+                   base_url=u'http://localhost/'):
+    '''
+    Return a synthetic BFS_OGD_metadata.xml with the given number of
+    packages, languages per package and resources per dataset
+    '''
+    root = etree.Element('packages')
+    for index in range(packages):
+        root.append(make_package(
+            index,
+            languages,
+            resources=resources,
+            base_url=base_url
+        ))
+    return etree.tostring(root, xml_declaration=True, encoding='utf-8')
@@ -0,0 +1,215 @@
+# coding: utf-8
+'''
+Offline benchmark of the FSO harvester
+
+Generates a synthetic catalogue, serves it and its resources from a
+local stand-in for www.bfs.admin.ch and times the stages of the
+FSOHarvester:
+
+  metadata  _generate_metadata for every package (no database needed)
+  gather    gather_stage of a new harvest job
+  import    gather_stage followed by import_stage of every object
+
+gather and import need a CKAN config file (--config) with ckanext-harvest
+installed, its database is used for the harvest objects and datasets.
+Use a throwaway database: with --reset-db it is rebuilt from scratch.
+
+Usage:
+
+  python benchmarks/harvest.py metadata --packages 500 --latency 0.02
+  python benchmarks/harvest.py import --config test.ini --reset-db
+'''
+
+import argparse
+import json
+import os
+import resource
+import sys
+import time
+
+from lxml import etree
+
+from catalogue import LANGUAGES, make_catalogue
+from server import StandInServer
+
+
+def percentiles(values, points=(50, 90, 99)):
+    ordered = sorted(values)
+    if not ordered:
+        return [(point, 0.0) for point in points]
+    return [
+        (point, ordered[int(round(point / 100.0 * (len(ordered) - 1)))])
+        for point in points
+    ]
+
+
+def peak_memory_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def report(name, count, seconds, latencies=None):
+    print '%-10s %6d in %8.2fs  %8.1f/s' % (
+        name, count, seconds, count / seconds if seconds else 0
+    )
+    if latencies:
+        print '%-10s %s' % ('', '  '.join(
+            'p%d %.1fms' % (point, value * 1000)
+            for point, value in percentiles(latencies)
+        ))
+
+
+def make_harvester(server, source_config):
+    from ckanext.fso.harvesters.fsoharvester import FSOHarvester
+
+    harvester = FSOHarvester()
+    harvester.METADATA_URL = server.metadata_url
+    harvester._set_config(json.dumps(source_config))
+    return harvester
+
+
+def bench_metadata(server, source_config):
+    from ckanext.fso.harvesters.record import package_records
+
+    harvester = make_harvester(server, source_config)
+    catalogue = etree.fromstring(server.metadata)
+
+    start = time.time()
+    harvester._probe_resources(list(catalogue))
+    report('probe', len(harvester._availability), time.time() - start)
+
+    latencies = []
+    start = time.time()
+    for package in catalogue:
+        package_start = time.time()
+        base_dataset, datasets = package_records(package)
+        harvester._generate_metadata(base_dataset, datasets)
+        latencies.append(time.time() - package_start)
+    report('metadata', len(latencies), time.time() - start, latencies)
+
+
+def load_ckan(config_path, reset_db):
+    from paste.deploy import appconfig
+    from ckan.config.environment import load_environment
+
+    conf = appconfig('config:' + os.path.abspath(config_path))
+    load_environment(conf.global_conf, conf.local_conf)
+
+    from ckan import model
+    from ckanext.harvest.model import setup
+
+    if reset_db:
+        model.repo.rebuild_db()
+    setup()
+
+    # the harvester acts as these users
+    for name in [u'harvest', u'admin']:
+        user = model.User.get(name) or model.User(name=name)
+        user.sysadmin = True
+        model.Session.add(user)
+    model.Session.commit()
+
+
+def create_job(server, source_config):
+    from ckanext.harvest.model import HarvestJob, HarvestSource
+
+    source = HarvestSource(
+        url=server.metadata_url,
+        type=u'fso',
+        config=json.dumps(source_config)
+    )
+    source.save()
+    job = HarvestJob(source=source)
+    job.save()
+    return job
+
+
+def bench_gather(server, source_config):
+    harvester = make_harvester(server, source_config)
+    job = create_job(server, source_config)
+
+    requests = server.requests
+    start = time.time()
+    ids = harvester.gather_stage(job)
+    report('gather', len(ids or []), time.time() - start)
+    print '%-10s %d HTTP requests' % ('', server.requests - requests)
+    return harvester, ids or []
+
+
+def bench_import(server, source_config):
+    from ckanext.harvest.model import HarvestObject
+
+    harvester, ids = bench_gather(server, source_config)
+
+    latencies = []
+    start = time.time()
+    for obj_id in ids:
+        obj = HarvestObject.get(obj_id)
+        object_start = time.time()
+        harvester.import_stage(obj)
+        latencies.append(time.time() - object_start)
+    report('import', len(latencies), time.time() - start, latencies)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n\n')[0].strip()
+    )
+    parser.add_argument('stage', choices=['metadata', 'gather', 'import'])
+    parser.add_argument('--packages', type=int, default=200)
+    parser.add_argument('--languages', type=int, default=len(LANGUAGES))
+    parser.add_argument('--resources', type=int, default=1,
+                        help='resources per dataset')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds before a resource request is answered')
+    parser.add_argument('--error-rate', type=float, default=0.05,
+                        help='share of resources answered with a 404')
+    parser.add_argument('--source-config', default='{}',
+                        help='harvest source config (JSON)')
+    parser.add_argument('--config', help='CKAN config file')
+    parser.add_argument('--reset-db', action='store_true',
+                        help='rebuild the database of the CKAN config')
+    args = parser.parse_args(argv)
+
+    if args.stage != 'metadata' and not args.config:
+        parser.error('the %s benchmark needs --config' % args.stage)
+
+    source_config = {'availability_cache': False}
+    source_config.update(json.loads(args.source_config))
+
+    server = StandInServer(
+        '',
+        latency=args.latency,
+        error_rate=args.error_rate
+    ).start()
+    server.metadata = make_catalogue(
+        args.packages,
+        LANGUAGES[:args.languages],
+        resources=args.resources,
+        base_url=unicode(server.base_url + '/xmlns/opendata/')
+    )
+    print '%d packages x %d languages x %d resources, %.1f MB catalogue' % (
+        args.packages, args.languages, args.resources,
+        len(server.metadata) / 1024.0 / 1024.0
+    )
+
+    try:
+        if args.stage == 'metadata':
+            bench_metadata(server, source_config)
+        else:
+            load_ckan(args.config, args.reset_db)
+            if args.stage == 'gather':
+                bench_gather(server, source_config)
+            else:
+                bench_import(server, source_config)
+    finally:
+        # close the keep-alive connections before the server goes away
+        from ckanext.fso.harvesters.client import get_client
+        get_client(source_config).pool.clear()
+        server.stop()
+
+    print 'peak memory %.1f MB' % peak_memory_mb()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
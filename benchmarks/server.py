@@ -0,0 +1,127 @@
+# coding: utf-8
+'''
+Local HTTP stand-in for www.bfs.admin.ch
+
+Serves a metadata file (with ETag, conditional requests and gzip) and
+answers requests for every other path as a resource file, after a
+configurable latency and with a configurable share of 404s.
+'''
+
+import gzip
+import hashlib
+import threading
+import time
+import zlib
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from StringIO import StringIO
+
+METADATA_PATH = '/xmlns/opendata/BFS_OGD_metadata.xml'
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, metadata, latency=0.0, error_rate=0.0, port=0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), _Handler)
+        self.metadata = metadata
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = 0
+        self.stopped = False
+        self._lock = threading.Lock()
+
+    @property
+    def etag(self):
+        return '"%s"' % hashlib.sha1(self.metadata).hexdigest()
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    @property
+    def metadata_url(self):
+        return self.base_url + METADATA_PATH
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.stopped = True
+        self.shutdown()
+        self.server_close()
+
+    def handle_error(self, request, client_address):
+        # keep-alive connections of the harvester are cut on exit
+        if not self.stopped:
+            HTTPServer.handle_error(self, request, client_address)
+
+    def count_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def is_missing(self, path):
+        '''
+        Whether a resource is missing, the same paths always fail
+        '''
+        bucket = zlib.crc32(path) % 10000
+        return bucket < self.error_rate * 10000
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # send each response in one write, otherwise keep-alive requests
+    # wait for delayed acks
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self._respond(body=False)
+
+    def do_GET(self):
+        self._respond(body=True)
+
+    def _respond(self, body):
+        self.server.count_request()
+        if self.path == METADATA_PATH:
+            return self._metadata(body)
+
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.is_missing(self.path):
+            self._send(404, 'not found', body)
+        else:
+            self._send(200, 'a,b\n1,2\n', body)
+
+    def _metadata(self, body):
+        if self.headers.get('If-None-Match') == self.server.etag:
+            self.send_response(304)
+            self.send_header('ETag', self.server.etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        content = self.server.metadata
+        headers = {'ETag': self.server.etag}
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            buf = StringIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb') as gzip_file:
+                gzip_file.write(content)
+            content = buf.getvalue()
+            headers['Content-Encoding'] = 'gzip'
+        self._send(200, content, body, headers)
+
+    def _send(self, status, content, body, headers=None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        if body:
+            self.wfile.write(content)
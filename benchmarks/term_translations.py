@@ -0,0 +1,69 @@
+# coding: utf-8
+'''
+Micro-benchmark of FSOHarvester._generate_term_translations
+
+Compares the current implementation with the previous one, which
+regenerated the notes of the base dataset and of every other dataset
+for all languages, on a package with four language variants.
+
+Usage: python benchmarks/term_translations.py [repetitions]
+'''
+
+import sys
+import timeit
+
+from ckanext.fso.harvesters.fsoharvester import FSOHarvester
+from ckanext.fso.harvesters.record import package_records
+
+from catalogue import make_package
+
+
+def legacy_term_translations(harvester, base_dataset, datasets):
+    '''
+    The notes part of _generate_term_translations before it generated
+    every language exactly once
+    '''
+    translations = []
+    for dataset in datasets:
+        if base_dataset.dataset_id != dataset.dataset_id:
+            for lang in harvester.NOTES_HELPERS:
+                if lang != 'de':
+                    translations.append({
+                        'lang_code': lang,
+                        'term': harvester._generate_notes(base_dataset, 'de'),
+                        'term_translation': harvester._generate_notes(
+                            dataset,
+                            lang
+                        )
+                    })
+    return translations
+
+
+def main(repetitions=2000):
+    harvester = FSOHarvester()
+    base_dataset, datasets = package_records(make_package(1))
+
+    legacy = timeit.timeit(
+        lambda: legacy_term_translations(harvester, base_dataset, datasets),
+        number=repetitions
+    )
+    current = timeit.timeit(
+        lambda: harvester._generate_term_translations(base_dataset, datasets),
+        number=repetitions
+    )
+
+    print 'notes translations per package: %d (legacy), %d (current)' % (
+        len(legacy_term_translations(harvester, base_dataset, datasets)),
+        len([
+            t for t in
+            harvester._generate_term_translations(base_dataset, datasets)
+            if t['term'].startswith('notes')
+        ])
+    )
+    print 'legacy:  %.1f us per package' % (legacy / repetitions * 1e6)
+    print 'current: %.1f us per package' % (current / repetitions * 1e6)
+    print 'speedup: %.1fx' % (legacy / current)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
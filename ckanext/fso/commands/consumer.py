@@ -0,0 +1,211 @@
+# coding: utf-8
+
+import Queue
+import inspect
+import signal
+import threading
+
+from ckan import model
+
+import logging
+log = logging.getLogger(__name__)
+
+# seconds between two rounds of acks sent from the connection's I/O loop
+ACK_INTERVAL = 0.1
+
+
+class ConcurrentConsumer(object):
+    '''
+    Handles the messages of a harvest queue with a pool of worker threads
+
+    At most `prefetch` messages are taken from the queue before they are
+    handled. Every worker uses its own (thread local) database session
+    and the workers share the harvester plugins, whose caches are guarded
+    by a lock (see OGDCHHarvesterBase). The gather callback runs a whole
+    gather per message and is not handled concurrently.
+
+    The callbacks acknowledge messages through a proxy channel, the acks
+    are only sent once the callback returned successfully, and from the
+    main thread (queue channels are not thread safe): every ACK_INTERVAL
+    from a timer of the connection while the main thread waits for
+    messages. Without such a timer they are sent when the consumer
+    returns, at the latest after an inactivity timeout of ACK_INTERVAL.
+    If the consumer has neither, the broker is not asked to limit the
+    unacknowledged messages (basic_qos), as they would never be acked.
+    Messages whose callback raised are requeued, the harvest objects count
+    their retries. On SIGTERM/SIGINT no more messages are taken and the
+    messages in flight are finished.
+    '''
+
+    def __init__(self, consumer, callback, workers=4, prefetch=None):
+        self.consumer = consumer
+        self.callback = callback
+        self.workers = max(1, int(workers))
+        self.prefetch = max(1, int(prefetch or self.workers))
+        self.tasks = Queue.Queue(maxsize=self.prefetch)
+        self.acks = Queue.Queue()
+        self.stopping = False
+
+    def stop(self, *args):
+        log.info('Stopping, waiting for the messages in flight')
+        self.stopping = True
+
+    def run(self, queue):
+        timer = self._start_ack_timer()
+        if not self._accepts_inactivity_timeout():
+            timeout = None
+        elif timer:
+            # only to notice a stop on an idle queue
+            timeout = 1
+        else:
+            timeout = ACK_INTERVAL
+        if hasattr(self.consumer, 'basic_qos'):
+            if timer or timeout:
+                self.consumer.basic_qos(prefetch_count=self.prefetch)
+            else:
+                log.warning('The consumer can not send acks while it waits, '
+                            'not limiting the unacknowledged messages')
+        signal.signal(signal.SIGTERM, self.stop)
+
+        threads = [
+            threading.Thread(target=self._work)
+            for _ in range(self.workers)
+        ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            for method, header, body in self._consume(queue, timeout):
+                self._send_acks()
+                if self.stopping:
+                    break
+                if method is None:
+                    # inactivity timeout
+                    continue
+                # blocks as long as `prefetch` messages are waiting
+                self.tasks.put((method, header, body))
+        except KeyboardInterrupt:
+            self.stop()
+        finally:
+            for thread in threads:
+                self.tasks.put(None)
+            for thread in threads:
+                thread.join()
+            self._send_acks()
+
+    def _consume(self, queue, timeout):
+        '''
+        Consume with an inactivity timeout if given, so that acks are sent
+        and a stop is noticed on an idle queue
+        '''
+        if timeout is None:
+            return self.consumer.consume(queue=queue)
+        return self.consumer.consume(queue=queue, inactivity_timeout=timeout)
+
+    def _accepts_inactivity_timeout(self):
+        try:
+            args, varargs, keywords, defaults = inspect.getargspec(
+                self.consumer.consume
+            )
+        except TypeError:
+            # not a Python function
+            return False
+        return 'inactivity_timeout' in args or keywords is not None
+
+    def _start_ack_timer(self):
+        '''
+        Sends the acks every ACK_INTERVAL from the I/O loop of the
+        connection (e.g. a pika BlockingConnection), which runs in the main
+        thread while it waits for messages. Returns False if the consumer
+        has no connection with timers.
+        '''
+        connection = getattr(self.consumer, 'connection', None)
+        # call_later since pika 1.0, add_timeout before
+        schedule = getattr(connection, 'call_later', None) or \
+            getattr(connection, 'add_timeout', None)
+        if schedule is None:
+            return False
+
+        def send_acks():
+            self._send_acks()
+            if not self.stopping:
+                schedule(ACK_INTERVAL, send_acks)
+        schedule(ACK_INTERVAL, send_acks)
+        return True
+
+    def _send_acks(self):
+        while True:
+            try:
+                action, delivery_tag = self.acks.get_nowait()
+            except Queue.Empty:
+                return
+            if action == 'ack':
+                self.consumer.basic_ack(delivery_tag)
+            else:
+                self.consumer.basic_reject(delivery_tag, requeue=True)
+
+    def _work(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            method, header, body = task
+            channel = _DeferredAckChannel(self.consumer)
+            try:
+                self.callback(channel, method, header, body)
+                for delivery_tag in channel.delivery_tags:
+                    self.acks.put(('ack', delivery_tag))
+            except Exception, e:
+                log.exception(e)
+                if hasattr(self.consumer, 'basic_reject'):
+                    self.acks.put(('reject', method.delivery_tag))
+            finally:
+                model.Session.remove()
+
+
+class _DeferredAckChannel(object):
+    '''
+    Channel passed to the callbacks, which records the acks instead of
+    sending them
+    '''
+
+    def __init__(self, consumer):
+        self._consumer = consumer
+        self.delivery_tags = []
+
+    def basic_ack(self, delivery_tag):
+        self.delivery_tags.append(delivery_tag)
+
+    def __getattr__(self, name):
+        return getattr(self._consumer, name)
+
+
+class MemoryConsumer(object):
+    '''
+    In-memory stand-in for a queue consumer (e.g. for tests): consumes
+    the given message bodies once and records the acks
+    '''
+
+    def __init__(self, bodies):
+        self.messages = [
+            (_Method(delivery_tag), None, body)
+            for delivery_tag, body in enumerate(bodies, 1)
+        ]
+        self.acked = []
+        self.rejected = []
+
+    def consume(self, queue=None, inactivity_timeout=None):
+        for message in self.messages:
+            yield message
+
+    def basic_ack(self, delivery_tag):
+        self.acked.append(delivery_tag)
+
+    def basic_reject(self, delivery_tag, requeue=True):
+        self.rejected.append(delivery_tag)
+
+
+class _Method(object):
+    def __init__(self, delivery_tag):
+        self.delivery_tag = delivery_tag
@@ -7,6 +7,8 @@ from ckan.logic import get_action, ValidationError
 
 from ckan.lib.cli import CkanCommand
 
+from ckanext.fso.harvesters.metrics import metrics
+
 class Harvester(CkanCommand):
     '''Harvests remotely mastered metadata
 
@@ -31,19 +33,26 @@ class Harvester(CkanCommand):
       harvester jobs
         - lists harvest jobs
 
-      harvester run
+      harvester [--profile={dir}] run
         - runs harvest jobs
 
-      harvester gather_consumer
+      harvester [--profile={dir}] gather_consumer
         - starts the consumer for the gathering queue
 
-      harvester fetch_consumer
+      harvester [--consumer-workers={n}] [--prefetch={n}] [--profile={dir}] fetch_consumer
         - starts the consumer for the fetching queue
 
+          With --consumer-workers, the messages are handled by that many threads at once.
+          --prefetch limits the number of messages taken from the queue ahead (default: one
+          per worker). Messages are acknowledged once they have been handled successfully,
+          messages whose handling failed are requeued. The threads share the harvester plugin,
+          whose gather stage (config, probe results, import chunks) is not thread safe, so the
+          gather consumer always handles one message at a time.
+
       harvester purge_queues
         - removes all jobs from fetch and gather queue
 
-      harvester [-j] [--segments={segments}] import [{source-id}]
+      harvester [-j] [--segments={segments}] [--workers={n}] [--chunk-size={n}] [--defer-indexing] [--index-batch-size={n}] import [{source-id}]
         - perform the import stage with the last fetched objects, optionally belonging to a certain source.
           Please note that no objects will be fetched from the remote server. It will only affect
           the last fetched objects already present in the database.
@@ -54,11 +63,41 @@ class Harvester(CkanCommand):
           The --segments flag allows to define a string containing hex digits that represent which of
           the 16 harvest object segments to import. e.g. 15af will run segments 1,5,a,f
 
+          The --workers flag splits the segments (all 16 by default) across that many processes,
+          which import them in parallel.
+
+          If --chunk-size is provided, the objects are imported in chunks of that many objects with
+          a single transaction per chunk. A failing chunk is imported again object by object.
+
+          If --defer-indexing is provided, the datasets are not indexed one by one while they are
+          imported but reindexed in batches of --index-batch-size (default 100) datasets.
+
+    With --profile, import, run and the consumers are profiled with cProfile. When the command
+    ends (or a consumer is stopped), the stats are written to {dir}/{stage}-{pid}.pstats along with
+    a text report of the slowest functions and the peak RSS. The gather consumer also writes the
+    memory usage and allocation hotspots of every gather stage to {dir}/gather-{pid}-{n}.memory.txt.
+
       harvester job-all
         - create new harvest jobs for all active sources.
 
-      harvester reindex
+      harvester [--index-batch-size={n}] reindex [{source-id}]
         - reindexes the harvest source datasets
+          If a source id is provided, the datasets harvested from this source are reindexed
+          in batches of --index-batch-size (default 100) datasets instead.
+
+      harvester [--probe-workers={n}] [--per-host={n}] [--rate={n}] [--no-cache] [--report={path}] check-links [{source-id}]
+        - checks the resource URLs of the FSO metadata file and writes a report with the status
+          and latency of every URL to --report (default links.csv, JSON for a .json path).
+          The URLs are checked by --probe-workers (default 16) threads, with at most --per-host
+          (default 4) requests in flight and --rate requests per second per host. Fresh results
+          of the availability cache are reused unless --no-cache is given. With a source id,
+          the config of that harvest source (HTTP client, availability cache) is used.
+          Exits with status 1 if another check is still running.
+
+      harvester stats {job-id}
+        - prints the timers and counters recorded for a harvest job by all harvester processes.
+          They are only recorded with ckanext.fso.metrics = true in the config file, see
+          ckanext.fso.metrics_dir and ckanext.fso.metrics_textfile (Prometheus) as well.
 
     The commands should be run from the ckanext-harvest directory and expect
     a development.ini file to be present. Most of the time you will
@@ -85,6 +124,42 @@ class Harvester(CkanCommand):
 '''A string containing hex digits that represent which of
  the 16 harvest object segments to import. e.g. 15af will run segments 1,5,a,f''')
 
+        self.parser.add_option('--consumer-workers', dest='consumer_workers',
+            type='int', default=1, help='Number of threads handling queue messages')
+
+        self.parser.add_option('--prefetch', dest='prefetch',
+            type='int', default=None, help='Number of queue messages to take ahead')
+
+        self.parser.add_option('--workers', dest='workers',
+            type='int', default=1, help='Number of processes to import the segments with')
+
+        self.parser.add_option('--chunk-size', dest='chunk_size',
+            type='int', default=0, help='Number of harvest objects to import in one transaction')
+
+        self.parser.add_option('--defer-indexing', dest='defer_indexing',
+            action='store_true', default=False, help='Reindex the imported datasets in batches')
+
+        self.parser.add_option('--index-batch-size', dest='index_batch_size',
+            type='int', default=100, help='Number of datasets to reindex at once')
+
+        self.parser.add_option('--probe-workers', dest='probe_workers',
+            type='int', default=16, help='Number of threads checking links')
+
+        self.parser.add_option('--per-host', dest='per_host',
+            type='int', default=4, help='Number of link checks in flight per host')
+
+        self.parser.add_option('--rate', dest='rate',
+            type='float', default=None, help='Number of link checks per second per host')
+
+        self.parser.add_option('--no-cache', dest='no_cache',
+            action='store_true', default=False, help='Check all links without the availability cache')
+
+        self.parser.add_option('--report', dest='report',
+            default='links.csv', help='Path of the link check report (.csv or .json)')
+
+        self.parser.add_option('--profile', dest='profile',
+            default=None, help='Directory to write the profiles of the stages to')
+
     def command(self):
         self._load_config()
 
@@ -111,21 +186,26 @@ class Harvester(CkanCommand):
         elif cmd == 'jobs':
             self.list_harvest_jobs()
         elif cmd == 'run':
-            self.run_harvester()
+            with self.profile_stage('run'):
+                self.run_harvester()
         elif cmd == 'gather_consumer':
+            if self.options.consumer_workers > 1:
+                print '--consumer-workers is only supported by the fetch_consumer'
+                sys.exit(1)
             import logging
             from ckanext.harvest.queue import get_gather_consumer, gather_callback
             logging.getLogger('amqplib').setLevel(logging.INFO)
             consumer = get_gather_consumer()
-            for method, header, body in consumer.consume(queue='ckan.harvest.gather'):
-                gather_callback(consumer, method, header, body)
+            with self.profile_stage('gather') as profiler:
+                self.consume(consumer, profiler.track_memory(gather_callback),
+                             'ckan.harvest.gather', profiler)
         elif cmd == 'fetch_consumer':
             import logging
             logging.getLogger('amqplib').setLevel(logging.INFO)
             from ckanext.harvest.queue import get_fetch_consumer, fetch_callback
             consumer = get_fetch_consumer()
-            for method, header, body in consumer.consume(queue='ckan.harvest.fetch'):
-               fetch_callback(consumer, method, header, body)
+            with self.profile_stage('fetch') as profiler:
+                self.consume(consumer, fetch_callback, 'ckan.harvest.fetch', profiler)
         elif cmd == 'purge_queues':
             from ckanext.harvest.queue import purge_queues
             purge_queues()
@@ -133,7 +213,8 @@ class Harvester(CkanCommand):
             self.initdb()
         elif cmd == 'import':
             self.initdb()
-            self.import_stage()
+            with self.profile_stage('import'):
+                self.import_stage()
         elif cmd == 'job-all':
             self.create_harvest_job_all()
         elif cmd == 'harvesters-info':
@@ -141,9 +222,31 @@ class Harvester(CkanCommand):
             pprint(harvesters_info)
         elif cmd == 'reindex':
             self.reindex()
+        elif cmd == 'stats':
+            self.print_job_stats()
+        elif cmd == 'check-links':
+            self.check_links()
         else:
             print 'Command %s not recognized' % cmd
 
+    def profile_stage(self, stage):
+        from ckanext.fso.commands.profiling import stage_profiler
+        return stage_profiler(self.options.profile, stage)
+
+    def consume(self, consumer, callback, queue, profiler):
+        try:
+            if self.options.consumer_workers > 1:
+                from ckanext.fso.commands.consumer import ConcurrentConsumer
+                # the worker threads are not covered by the profiler of the main thread
+                ConcurrentConsumer(consumer, profiler.profiled(callback),
+                                   workers=self.options.consumer_workers,
+                                   prefetch=self.options.prefetch).run(queue)
+            else:
+                for method, header, body in consumer.consume(queue=queue):
+                    callback(consumer, method, header, body)
+        finally:
+            metrics.stop()
+
     def _load_config(self):
         super(Harvester, self)._load_config()
 
@@ -273,14 +376,172 @@ class Harvester(CkanCommand):
         else:
             source_id = None
 
-        context = {'model': model, 'session':model.Session, 'user': self.admin_user['name'],
-                   'join_datasets': not self.options.no_join_datasets,
-                   'segments': self.options.segments}
-
+        if self.options.workers > 1:
+            count = self.import_workers(source_id)
+        else:
+            count = len(self.import_segments(source_id, self.options.segments))
 
-        objs = get_action('harvest_objects_import')(context,{'source_id':source_id})
+        print '%s objects reimported' % count
 
-        print '%s objects reimported' % len(objs)
+    def import_segments(self, source_id, segments):
+        context = {'model': model, 'session':model.Session, 'user': self.admin_user['name'],
+                   'join_datasets': not self.options.no_join_datasets,
+                   'segments': segments}
+
+        if self.options.defer_indexing:
+            from ckanext.fso.harvesters.indexing import deferred_indexer
+            deferred_indexer.suspend(self.options.index_batch_size)
+        # the objects belong to many jobs, keep the caches of the harvesters for the whole import
+        harvesters = [harvester for harvester in self.import_harvesters().values()
+                      if hasattr(harvester, 'begin_import_run')]
+        for harvester in harvesters:
+            harvester.begin_import_run()
+        try:
+            if self.options.chunk_size:
+                objs = self.import_chunks(source_id, segments)
+            else:
+                objs = get_action('harvest_objects_import')(context,{'source_id':source_id})
+        finally:
+            for harvester in harvesters:
+                harvester.end_import_run()
+            if self.options.defer_indexing:
+                deferred_indexer.resume()
+            metrics.flush()
+
+        return objs
+
+    def import_workers(self, source_id):
+        '''
+        Splits the harvest object segments across --workers processes and
+        returns the total number of reimported objects
+        '''
+        from multiprocessing import Process, Queue
+
+        segments = self.options.segments or '0123456789abcdef'
+        workers = min(self.options.workers, len(segments))
+        parts = [segments[i::workers] for i in range(workers)]
+
+        # Every worker opens its own database connections
+        model.Session.remove()
+        model.meta.engine.dispose()
+
+        results = Queue()
+        processes = [Process(target=self.import_worker, args=(source_id, part, results))
+                     for part in parts]
+        for process in processes:
+            process.start()
+        # get the results before joining, a worker only exits once its result is consumed
+        worker_results = self.collect_worker_results(processes, parts, results)
+        for process in processes:
+            process.join()
+
+        count = 0
+        errors = 0
+        for part, part_count, error in sorted(worker_results):
+            count += part_count
+            if error:
+                errors += 1
+                print 'Importing segments %s failed: %s' % (part, error)
+            else:
+                print 'Segments %s: %s objects reimported' % (part, part_count)
+        if errors:
+            print '%s of %s workers failed' % (errors, len(processes))
+        return count
+
+    def collect_worker_results(self, processes, parts, results, poll_interval=5):
+        '''
+        Returns the (segments, count, error) result of every worker. A worker which
+        died without a result (e.g. killed for running out of memory) counts as failed
+        once no result arrived for two more poll intervals.
+        '''
+        from Queue import Empty
+
+        worker_results = {}
+        missing = set()
+        while len(worker_results) < len(processes):
+            try:
+                part, part_count, error = results.get(timeout=poll_interval)
+                worker_results[part] = (part, part_count, error)
+                continue
+            except Empty:
+                pass
+            for process, part in zip(processes, parts):
+                if part in worker_results or process.is_alive():
+                    continue
+                if part in missing:
+                    worker_results[part] = (part, 0, 'worker exited with code %s without a result'
+                                                     % process.exitcode)
+                else:
+                    missing.add(part)
+        return worker_results.values()
+
+    def import_worker(self, source_id, segments, results):
+        try:
+            # every worker process writes its own profile
+            with self.profile_stage('import'):
+                objs = self.import_segments(source_id, segments)
+            results.put((segments, len(objs), None))
+        except Exception, e:
+            import traceback
+            traceback.print_exc()
+            results.put((segments, 0, '%r' % e))
+        finally:
+            # workers exit without running the atexit hooks
+            metrics.stop()
+            model.Session.remove()
+
+    def import_chunks(self, source_id, segments):
+        '''
+        Imports the same objects as the harvest_objects_import action, but
+        in chunks of --chunk-size objects with one transaction per chunk
+        '''
+        import hashlib
+        from ckanext.harvest.model import HarvestJob, HarvestObject
+
+        query = model.Session.query(HarvestObject.id) \
+            .filter(HarvestObject.current == True)
+        # like harvest_objects_import, -j also imports objects without a dataset
+        if not self.options.no_join_datasets:
+            query = query.join(model.Package, model.Package.id == HarvestObject.package_id) \
+                .filter(model.Package.state == u'active')
+        if source_id:
+            query = query.join(HarvestJob, HarvestObject.harvest_job_id == HarvestJob.id) \
+                .filter(HarvestJob.source_id == source_id)
+        object_ids = [obj_id for obj_id, in query]
+        if segments:
+            object_ids = [obj_id for obj_id in object_ids
+                          if hashlib.md5(obj_id).hexdigest()[0] in segments]
+
+        harvesters = self.import_harvesters()
+
+        chunk_size = self.options.chunk_size
+        for start in range(0, len(object_ids), chunk_size):
+            chunks = {}
+            for obj_id in object_ids[start:start + chunk_size]:
+                obj = model.Session.query(HarvestObject).get(obj_id)
+                chunks.setdefault(obj.job.source.type, []).append(obj)
+
+            for source_type, objs in chunks.items():
+                harvester = harvesters[source_type]
+                if hasattr(harvester, 'force_import'):
+                    harvester.force_import = True
+                if hasattr(harvester, 'import_chunk'):
+                    harvester.import_chunk(objs)
+                else:
+                    for obj in objs:
+                        harvester.import_stage(obj)
+
+        return object_ids
+
+    def import_harvesters(self):
+        '''
+        Returns the harvester plugins by source type
+        '''
+        from ckan import plugins as p
+        from ckanext.harvest.interfaces import IHarvester
+
+        return dict((harvester.info()['name'], harvester)
+                    for harvester in p.PluginImplementations(IHarvester))
 
     def create_harvest_job_all(self):
         context = {'model': model, 'user': self.admin_user['name'], 'session':model.Session}
@@ -288,9 +549,116 @@ class Harvester(CkanCommand):
         print 'Created %s new harvest jobs' % len(jobs)
 
     def reindex(self):
+        if len(self.args) >= 2:
+            self.reindex_source_datasets(unicode(self.args[1]))
+            return
         context = {'model': model, 'user': self.admin_user['name']}
         get_action('harvest_sources_reindex')(context,{})
 
+    def reindex_source_datasets(self, source_id):
+        from ckanext.harvest.model import HarvestJob, HarvestObject
+        from ckanext.fso.harvesters.indexing import DeferredIndexer
+
+        package_ids = model.Session.query(HarvestObject.package_id) \
+            .join(HarvestJob, HarvestObject.harvest_job_id == HarvestJob.id) \
+            .filter(HarvestJob.source_id == source_id) \
+            .filter(HarvestObject.current == True) \
+            .filter(HarvestObject.package_id != None) \
+            .distinct()
+
+        indexer = DeferredIndexer()
+        indexer.batch_size = self.options.index_batch_size
+        count = 0
+        for package_id, in package_ids:
+            indexer.touch(package_id)
+            count += 1
+        indexer.flush()
+
+        print '%s datasets reindexed' % count
+
+
+    def check_links(self):
+        import fcntl
+        from ckanext.fso.harvesters.client import get_client
+        from ckanext.fso.harvesters.fsoharvester import FSOHarvester
+        from ckanext.fso.harvesters.linkcheck import LinkChecker, catalogue_links, write_report
+
+        harvester = FSOHarvester()
+        if len(self.args) >= 2:
+            from ckanext.harvest.model import HarvestSource
+            source = HarvestSource.get(unicode(self.args[1]))
+            if not source:
+                print 'Harvest source %s not found' % self.args[1]
+                sys.exit(1)
+            harvester._set_config(source.config)
+        else:
+            harvester._set_config(None)
+
+        # scheduled checks must not overlap
+        lock_file = open(self.options.report + '.lock', 'w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            print 'Another link check is writing %s' % self.options.report
+            sys.exit(1)
+
+        client = get_client(harvester.config)
+        cache = None if self.options.no_cache else harvester._availability_cache()
+        metadata_file = client.request('GET', harvester.METADATA_URL, preload_content=False)
+        if metadata_file.status != 200:
+            print 'Unable to get the metadata file (HTTP %s)' % metadata_file.status
+            sys.exit(1)
+        links = list(catalogue_links(metadata_file))
+        metadata_file.release_conn()
+
+        checker = LinkChecker(client, cache,
+                              workers=self.options.probe_workers,
+                              per_host=self.options.per_host,
+                              rate=self.options.rate)
+        results = checker.check(links)
+        write_report(results, self.options.report)
+        if cache:
+            cache.flush()
+
+        missing = [result for result in results if not result['available']]
+        latencies = sorted(result['latency'] for result in results if result['latency'] is not None)
+        print '%s links checked, %s missing, %s from the cache' % (
+            len(results), len(missing), len([result for result in results if result['cached']]))
+        if latencies:
+            print 'latency: median %.0fms, max %.0fms' % (
+                latencies[len(latencies) // 2] * 1000, latencies[-1] * 1000)
+        print 'Report written to %s' % self.options.report
+
+    def print_job_stats(self):
+        from ckanext.fso.harvesters.metrics import metrics_settings, load_summaries, merge_summaries
+
+        if len(self.args) >= 2:
+            job_id = unicode(self.args[1])
+        else:
+            print 'Please provide a job id'
+            sys.exit(1)
+
+        enabled, directory, textfile = metrics_settings()
+        summaries = load_summaries(directory, job_id)
+        if not summaries:
+            print 'No metrics recorded for job %s in %s' % (job_id, directory)
+            sys.exit(1)
+        stats = merge_summaries(summaries)
+
+        print '       Job id: %s' % job_id
+        print '    processes: %s' % stats['processes']
+        print '      updated: %s' % stats['updated']
+        print ''
+        print '%-36s %10s %12s %10s %10s' % ('timer', 'count', 'total (s)', 'avg (ms)', 'max (ms)')
+        for name, timer in sorted(stats['timers'].items()):
+            print '%-36s %10d %12.2f %10.1f %10.1f' % (
+                name, timer['count'], timer['seconds'],
+                timer['seconds'] / timer['count'] * 1000 if timer['count'] else 0,
+                timer['max'] * 1000)
+        print ''
+        print '%-36s %10s' % ('counter', 'value')
+        for name, value in sorted(stats['counters'].items()):
+            print '%-36s %10d' % (name, value)
 
     def print_harvest_sources(self, sources):
         if sources:
@@ -0,0 +1,241 @@
+# coding: utf-8
+
+import os
+import gc
+import sys
+import time
+import signal
+import pstats
+import cProfile
+import resource
+import threading
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2, unless patched with pytracemalloc
+    tracemalloc = None
+
+import logging
+log = logging.getLogger(__name__)
+
+TOP_FUNCTIONS = 40
+TOP_ALLOCATIONS = 25
+
+
+def stage_profiler(directory, stage):
+    '''
+    Returns a profiler for a stage of the harvester command, which does
+    nothing if no directory is given
+    '''
+    if directory:
+        return StageProfiler(directory, stage)
+    return NullProfiler()
+
+
+class StageProfiler(object):
+    '''
+    Profiles a stage of the harvester command with cProfile
+
+    The stats of the thread entering the profiler and of all threads
+    running a function wrapped with profiled() are added up and written to
+    {directory}/{stage}-{pid}.pstats (for pstats, snakeviz, gprof2dot...)
+    when the stage ends, also on SIGTERM. {stage}-{pid}.txt lists the
+    functions with the highest cumulative time and the peak RSS.
+    '''
+
+    def __init__(self, directory, stage):
+        self.directory = directory
+        self.stage = stage
+        self.messages = 0
+        self._profiles = []
+        self._main = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def path(self, suffix):
+        return os.path.join(
+            self.directory,
+            '%s-%d.%s' % (self.stage, os.getpid(), suffix)
+        )
+
+    def __enter__(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        # stop a consumer with SystemExit, so that the stats are written
+        if signal.getsignal(signal.SIGTERM) == signal.SIG_DFL:
+            signal.signal(signal.SIGTERM, _exit)
+        self._main = self._profile()
+        self._started = time.time()
+        self._main.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._main.disable()
+        self.dump(time.time() - self._started)
+
+    def _profile(self):
+        profile = cProfile.Profile()
+        with self._lock:
+            self._profiles.append(profile)
+        return profile
+
+    def profiled(self, function):
+        '''
+        Wraps a function run by other (worker) threads, which are not
+        covered by the profiler of the main thread
+        '''
+        def wrapper(*args, **kwargs):
+            profile = getattr(self._local, 'profile', None)
+            if profile is None:
+                profile = self._local.profile = self._profile()
+            return profile.runcall(function, *args, **kwargs)
+        return wrapper
+
+    def track_memory(self, function):
+        '''
+        Wraps a function (e.g. the gather callback) to write the memory
+        report of every call to {stage}-{pid}-{n}.memory.txt
+        '''
+        def wrapper(*args, **kwargs):
+            with self._lock:
+                self.messages += 1
+                path = self.path('%d.memory.txt' % self.messages)
+            with MemoryTracker(path):
+                return function(*args, **kwargs)
+        return wrapper
+
+    def dump(self, seconds):
+        with self._lock:
+            profiles = list(self._profiles)
+        stats = None
+        for profile in profiles:
+            profile.create_stats()
+            if not profile.stats:
+                continue
+            if stats is None:
+                stats = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+        if stats is None:
+            log.info('Nothing profiled for the %s stage' % self.stage)
+            return
+
+        stats.dump_stats(self.path('pstats'))
+        with open(self.path('txt'), 'w') as report:
+            report.write('%s stage, pid %d, %.1fs\n' % (
+                self.stage, os.getpid(), seconds
+            ))
+            report.write('peak RSS: %.1f MB\n\n' % peak_rss_mb())
+            stats.stream = report
+            stats.sort_stats('cumulative').print_stats(TOP_FUNCTIONS)
+        log.info('Profile of the %s stage written to %s' % (
+            self.stage, self.path('pstats')
+        ))
+
+
+class NullProfiler(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def profiled(self, function):
+        return function
+
+    def track_memory(self, function):
+        return function
+
+
+class MemoryTracker(object):
+    '''
+    Writes the peak RSS and the allocation hotspots of a block to a file
+
+    The hotspots are the source lines which allocated most of the memory
+    still in use at the end of the block according to tracemalloc. Without
+    tracemalloc (Python 2), they are the types of which most objects were
+    added and are still alive.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        self._rss = current_rss_mb()
+        if tracemalloc:
+            self._tracing = tracemalloc.is_tracing()
+            if not self._tracing:
+                tracemalloc.start()
+            self._before = tracemalloc.take_snapshot()
+        else:
+            gc.collect()
+            self._before = _type_counts()
+        return self
+
+    def __exit__(self, *exc_info):
+        with open(self.path, 'w') as report:
+            report.write('peak RSS: %.1f MB\n' % peak_rss_mb())
+            rss = current_rss_mb()
+            if rss is not None and self._rss is not None:
+                report.write('RSS: %.1f MB -> %.1f MB\n' % (self._rss, rss))
+            report.write('\n')
+            if tracemalloc:
+                self._write_allocations(report)
+            else:
+                self._write_growth(report)
+
+    def _write_allocations(self, report):
+        snapshot = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+        if not self._tracing:
+            tracemalloc.stop()
+        report.write('traced peak: %.1f MB\n' % (peak / 1024.0 / 1024.0))
+        report.write('top %d allocations by line:\n' % TOP_ALLOCATIONS)
+        top = snapshot.compare_to(self._before, 'lineno')[:TOP_ALLOCATIONS]
+        for stat in top:
+            report.write('%s\n' % stat)
+
+    def _write_growth(self, report):
+        gc.collect()
+        after = _type_counts()
+        growth = sorted(
+            ((count - self._before.get(name, 0), name)
+             for name, count in after.items()),
+            reverse=True
+        )[:TOP_ALLOCATIONS]
+        report.write('top %d types by new objects still alive:\n'
+                     % TOP_ALLOCATIONS)
+        for count, name in growth:
+            if count <= 0:
+                break
+            report.write('%10d %s\n' % (count, name))
+
+
+def _type_counts():
+    counts = {}
+    for obj in gc.get_objects():
+        name = type(obj).__name__
+        counts[name] = counts.get(name, 0) + 1
+    return counts
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux, in bytes on OS X
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return maxrss / 1024.0 / 1024.0
+    return maxrss / 1024.0
+
+
+def current_rss_mb():
+    try:
+        with open('/proc/self/statm') as statm:
+            pages = int(statm.read().split()[1])
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+    return pages * resource.getpagesize() / 1024.0 / 1024.0
+
+
+def _exit(signum, frame):
+    sys.exit(128 + signum)
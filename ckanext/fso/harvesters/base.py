@@ -1,3 +1,5 @@
+import threading
+
 from ckanext.harvest.harvesters import HarvesterBase
 
 from sqlalchemy.sql import update,and_, bindparam
@@ -6,15 +8,298 @@ from sqlalchemy.exc import InvalidRequestError
 from ckan import plugins as p
 from ckan import model
 from ckan.model import Session
-from ckan.logic import ValidationError, NotFound, get_action
+from ckan.logic import ValidationError, get_action
 from ckan.logic.schema import default_create_package_schema
 from ckan.lib.navl.validators import ignore_missing,ignore
 from ckan.lib.munge import munge_tag
+from ckan.lib.dictization.model_save import package_resource_list_save, package_extras_save
+
+from ckanext.fso.harvesters.indexing import deferred_indexer
+from ckanext.fso.harvesters.metrics import metrics
 
 import logging
 log = logging.getLogger(__name__)
 
 class OGDCHHarvesterBase(HarvesterBase):
+
+    # name and modification date of all packages by id, see _get_package_index
+    _package_index = None
+    _package_index_jobs = set()
+    # ids of all packages by name
+    _name_index = None
+    # guards the caches shared by the threads of a concurrent consumer
+    _cache_lock = threading.RLock()
+
+    # state of the chunk being imported, see import_chunk
+    _chunk = None
+
+    # whether the caches are kept for an import run, see begin_import_run
+    _import_run = False
+
+    def begin_import_run(self):
+        '''
+        Keeps the caches of the harvester (package and name index, group
+        and organization ids) for a whole import run, e.g. a reimport of
+        the current objects of many jobs, instead of reloading them as
+        soon as an object of another job is imported. They are dropped
+        again by end_import_run.
+        '''
+        with OGDCHHarvesterBase._cache_lock:
+            self._reset_job_caches()
+            OGDCHHarvesterBase._import_run = True
+
+    def end_import_run(self):
+        with OGDCHHarvesterBase._cache_lock:
+            OGDCHHarvesterBase._import_run = False
+            self._reset_job_caches()
+
+    def _job_caches_stale(self, cached_job_ids, job_id):
+        '''
+        Whether caches loaded for the jobs cached_job_ids must be reloaded
+        to import an object of job_id: outside of an import run, every
+        harvest job (e.g. taken from the fetch queue) starts with fresh
+        caches. Reloaded caches stay valid for the jobs seen before, so
+        that the objects of interleaving jobs do not reload them again and
+        again.
+        '''
+        return not OGDCHHarvesterBase._import_run and job_id not in cached_job_ids
+
+    def _get_package_index(self, job_id):
+        '''
+        Returns the name and metadata_modified (ISO format) of all packages
+        by id. The index is loaded with a single query once per harvest job
+        (or import run) and kept up to date with the packages it creates or
+        updates.
+        '''
+        with OGDCHHarvesterBase._cache_lock:
+            if OGDCHHarvesterBase._package_index is None or \
+               self._job_caches_stale(OGDCHHarvesterBase._package_index_jobs, job_id):
+                query = Session.query(model.Package.id, model.Package.name,
+                                      model.Package.metadata_modified)
+                index = {}
+                for id, name, metadata_modified in query:
+                    index[id] = {
+                        'name': name,
+                        'metadata_modified': metadata_modified and metadata_modified.isoformat(),
+                    }
+                OGDCHHarvesterBase._package_index = index
+                OGDCHHarvesterBase._name_index = dict((package['name'], id) for id, package in index.items())
+                OGDCHHarvesterBase._package_index_jobs = OGDCHHarvesterBase._package_index_jobs | set([job_id])
+            return OGDCHHarvesterBase._package_index
+
+    def _get_name_index(self, job_id):
+        '''
+        Returns the ids of all packages by name, loaded and kept up to date
+        together with the package index
+        '''
+        with OGDCHHarvesterBase._cache_lock:
+            self._get_package_index(job_id)
+            return OGDCHHarvesterBase._name_index
+
+    def _index_package(self, id, name, metadata_modified):
+        '''
+        Adds a created or updated package to the package and name index
+        '''
+        with OGDCHHarvesterBase._cache_lock:
+            package_index = OGDCHHarvesterBase._package_index
+            name_index = OGDCHHarvesterBase._name_index
+            if package_index is None:
+                # dropped meanwhile, reloaded with the package
+                return
+            if id in package_index and name_index.get(package_index[id]['name']) == id:
+                del name_index[package_index[id]['name']]
+            package_index[id] = {
+                'name': name,
+                'metadata_modified': metadata_modified,
+            }
+            name_index[name] = id
+
+    def _normalise_package(self, package_dict):
+        '''
+        Returns the parts of a package the harvester sets in a comparable
+        form. Works with REST style package dicts (as passed to
+        _create_or_update_package) and with the output of package_show.
+        '''
+        core = {}
+        for key in ['name', 'title', 'notes', 'author', 'maintainer',
+                    'maintainer_email', 'license_id', 'owner_org']:
+            core[key] = package_dict.get(key) or None
+
+        tags = set()
+        for tag in package_dict.get('tags') or []:
+            tags.add(tag['name'] if isinstance(tag, dict) else tag)
+
+        groups = set()
+        for group in package_dict.get('groups') or []:
+            groups.add(group['title'] if isinstance(group, dict) else group)
+
+        extras = package_dict.get('extras') or {}
+        if isinstance(extras, list):
+            extras = dict((extra['key'], extra['value']) if isinstance(extra, dict)
+                          else tuple(extra) for extra in extras)
+
+        return {
+            'core': core,
+            'tags': tags,
+            'groups': groups,
+            'resources': [self._normalise_resource(resource)
+                          for resource in package_dict.get('resources') or []],
+            'extras': extras,
+        }
+
+    def _normalise_resource(self, resource):
+        return (resource.get('url') or None,
+                resource.get('name') or None,
+                (resource.get('format') or '').lower() or None)
+
+    def _package_changes(self, package_dict, stored_package):
+        '''
+        Returns the set of parts (core, tags, groups, resources, extras)
+        which differ between an incoming and a stored package
+
+        Only the extras set by the harvester are compared, the others are
+        kept by an update (like package_update_rest does).
+        '''
+        new = self._normalise_package(package_dict)
+        old = self._normalise_package(stored_package)
+        old['extras'] = dict((key, value) for key, value in old['extras'].items()
+                             if key in new['extras'])
+        return set(part for part in new if new[part] != old[part])
+
+    def _update_package_parts(self, package_dict, stored_package, changes, context):
+        '''
+        Writes only the resources and/or extras of an existing package in
+        a new revision, instead of a full package update
+        '''
+        rev = model.repo.new_revision()
+        rev.author = context['user']
+        rev.message = u'Harvester: update %s' % ', '.join(sorted(changes))
+
+        package = model.Package.get(package_dict['id'])
+        if 'resources' in changes:
+            # keep the ids of the stored resources in the same position
+            resources = []
+            stored_resources = stored_package.get('resources') or []
+            for position, resource in enumerate(package_dict['resources']):
+                resource = dict(resource)
+                if position < len(stored_resources):
+                    resource['id'] = stored_resources[position]['id']
+                resources.append(resource)
+            package_resource_list_save(resources, package, context)
+
+        if 'extras' in changes:
+            # package_extras_save deletes the extras not passed, merge the
+            # ones of the harvester into the stored ones
+            extras = self._normalise_package(stored_package)['extras']
+            extras.update(self._normalise_package(package_dict)['extras'])
+            package_extras_save([{'key': key, 'value': value} for key, value in extras.items()],
+                                package, context)
+
+        if self._chunk is None:
+            metrics.incr('db.commits')
+            model.repo.commit()
+
+    def _same_as_current(self, harvest_object, package_id):
+        '''
+        Returns whether the current harvest object of a package has the
+        same content as the given one, so that the stored package does
+        not need to be loaded and compared
+        '''
+        from ckanext.harvest.model import HarvestObject
+        with metrics.timer('import.current_content'):
+            current = Session.query(HarvestObject.content) \
+                    .filter(HarvestObject.package_id==package_id) \
+                    .filter(HarvestObject.current==True) \
+                    .filter(HarvestObject.id!=harvest_object.id) \
+                    .first()
+        return current is not None and current[0] == harvest_object.content
+
+    def _name_conflict(self, package_dict, harvest_object):
+        '''
+        Returns another name for a package whose name was taken when it
+        was created, or None to give up. Harvesters generating names
+        should override this.
+        '''
+        return None
+
+    def _finish_chunk(self):
+        '''
+        Called before a chunk is committed, to write what the harvester
+        collected for the whole chunk (see import_chunk)
+        '''
+        pass
+
+    def _reset_job_caches(self):
+        '''
+        Drops everything cached for the current harvest job, e.g. after a
+        rollback. Harvesters with their own caches should extend this.
+        '''
+        with OGDCHHarvesterBase._cache_lock:
+            OGDCHHarvesterBase._package_index = None
+            OGDCHHarvesterBase._name_index = None
+            OGDCHHarvesterBase._package_index_jobs = set()
+
+    def import_chunk(self, harvest_objects):
+        '''
+        Imports several harvest objects in a single transaction
+
+        The other objects of the updated packages are flagged as not
+        current with one statement and everything is committed once. If
+        the chunk fails it is rolled back and the objects are imported one
+        by one, so that errors are saved with the right object.
+        '''
+        from ckanext.harvest.model import harvest_object_table
+
+        self._chunk = {'package_ids': set(), 'written': []}
+        metrics.incr('import.chunks')
+        try:
+            for harvest_object in harvest_objects:
+                self.import_stage(harvest_object)
+
+            Session.flush()
+            if self._chunk['package_ids']:
+                table = harvest_object_table
+                Session.connection().execute(
+                    update(table).where(and_(
+                        table.c.package_id.in_(list(self._chunk['package_ids'])),
+                        ~table.c.id.in_([obj.id for obj in harvest_objects])
+                    )).values(current=False)
+                )
+            self._finish_chunk()
+            for harvest_object in harvest_objects:
+                harvest_object.state = u'COMPLETE'
+            metrics.incr('db.commits')
+            Session.commit()
+            written = self._chunk['written']
+        except Exception, e:
+            log.warning('Importing the chunk of %d objects failed (%r), importing them one by one'
+                        % (len(harvest_objects), e))
+            metrics.incr('import.failed_chunks')
+            Session.rollback()
+            self._reset_job_caches()
+            self._chunk = None
+            for harvest_object in harvest_objects:
+                try:
+                    if self.import_stage(harvest_object):
+                        harvest_object.state = u'COMPLETE'
+                    else:
+                        harvest_object.state = u'ERROR'
+                except Exception, e:
+                    log.exception(e)
+                    Session.rollback()
+                    self._save_object_error('%r' % e, harvest_object, 'Import')
+                    harvest_object.state = u'ERROR'
+                    harvest_object.report_status = u'errored'
+                harvest_object.save()
+            return
+        finally:
+            self._chunk = None
+            metrics.flush()
+
+        if deferred_indexer.active:
+            for package_id in written:
+                deferred_indexer.touch(package_id)
+
     def _create_or_update_package(self, package_dict, harvest_object):
         '''
         Creates a new package or updates an exisiting one according to the
@@ -60,6 +345,7 @@ class OGDCHHarvesterBase(HarvesterBase):
                 'user': user_name,
                 'api_version': api_version,
                 'schema': schema,
+                'defer_commit': self._chunk is not None,
             }
 
             tags = package_dict.get('tags', [])
@@ -68,37 +354,75 @@ class OGDCHHarvesterBase(HarvesterBase):
             package_dict['tags'] = tags
 
             # Check if package exists
-            data_dict = {}
-            data_dict['id'] = package_dict['id']
-            try:
-                existing_package_dict = get_action('package_show')(context, data_dict)
+            written = True
+            package_index = self._get_package_index(harvest_object.harvest_job_id)
+            existing_package = package_index.get(package_dict['id'])
+            if existing_package:
                 # Check modified date
                 if not 'metadata_modified' in package_dict or \
-                   package_dict['metadata_modified'] > existing_package_dict.get('metadata_modified'):
-                    log.info('Package with GUID %s exists and needs to be updated' % harvest_object.guid)
-                    # Update package
-                    context.update({'id':package_dict['id']})
-                    new_package = get_action('package_update_rest')(context, package_dict)
+                   package_dict['metadata_modified'] > existing_package['metadata_modified']:
+                    if existing_package['name'] == package_dict['name'] and \
+                       self._same_as_current(harvest_object, package_dict['id']):
+                        # the same content has been imported already
+                        changes = set()
+                    else:
+                        # Compare with the stored package to only write what changed
+                        show_context = {'model': model, 'session': Session, 'user': user_name,
+                                        'defer_commit': self._chunk is not None}
+                        with metrics.timer('action.package_show'):
+                            stored_package = get_action('package_show')(show_context, {'id': package_dict['id']})
+                        changes = self._package_changes(package_dict, stored_package)
+
+                    if not changes:
+                        log.info('Package with GUID %s did not change, skipping update' % harvest_object.guid)
+                        metrics.incr('import.unchanged')
+                        harvest_object.report_status = u'not modified'
+                        new_package = dict(existing_package, id=package_dict['id'])
+                        written = False
+                    elif changes <= set(['resources', 'extras']):
+                        log.info('Package with GUID %s exists, updating its %s' % (harvest_object.guid, ' and '.join(sorted(changes))))
+                        metrics.incr('import.partially_updated')
+                        harvest_object.report_status = u'updated'
+                        with metrics.timer('import.update_parts'):
+                            self._update_package_parts(package_dict, stored_package, changes, show_context)
+                        new_package = dict(existing_package, id=package_dict['id'], metadata_modified=None)
+                    else:
+                        log.info('Package with GUID %s exists and needs to be updated' % harvest_object.guid)
+                        metrics.incr('import.updated')
+                        harvest_object.report_status = u'updated'
+                        # Update package
+                        context.update({'id':package_dict['id']})
+                        with metrics.timer('action.package_update_rest'):
+                            new_package = get_action('package_update_rest')(context, package_dict)
 
                 else:
                     log.info('Package with GUID %s not updated, skipping...' % harvest_object.guid)
-                    return
+                    metrics.incr('import.not_modified')
+                    harvest_object.report_status = u'not modified'
+                    return True
 
                 # Flag the other objects linking to this package as not current anymore
-                from ckanext.harvest.model import harvest_object_table
-                conn = Session.connection()
-                u = update(harvest_object_table) \
-                        .where(harvest_object_table.c.package_id==bindparam('b_package_id')) \
-                        .values(current=False)
-                conn.execute(u, b_package_id=new_package['id'])
+                # (for a whole chunk at once when importing chunks)
+                if self._chunk is not None:
+                    self._chunk['package_ids'].add(new_package['id'])
+                else:
+                    from ckanext.harvest.model import harvest_object_table
+                    conn = Session.connection()
+                    u = update(harvest_object_table) \
+                            .where(harvest_object_table.c.package_id==bindparam('b_package_id')) \
+                            .values(current=False)
+                    conn.execute(u, b_package_id=new_package['id'])
 
                 # Flag this as the current harvest object
 
                 harvest_object.package_id = new_package['id']
                 harvest_object.current = True
-                harvest_object.save()
+                if self._chunk is not None:
+                    harvest_object.add()
+                else:
+                    harvest_object.save()
 
-            except NotFound:
+            else:
                 # Package needs to be created
                 log.info('Package with GUID %s does not exist, let\'s create it' % harvest_object.guid)
                 harvest_object.current = True
@@ -111,17 +435,47 @@ class OGDCHHarvesterBase(HarvesterBase):
                 model.Session.execute('SET CONSTRAINTS harvest_object_package_id_fkey DEFERRED')
                 model.Session.flush()
 
-                new_package = get_action('package_create_rest')(context, package_dict)
+                metrics.incr('import.created')
+                harvest_object.report_status = u'added'
+                with metrics.timer('action.package_create_rest'):
+                    try:
+                        new_package = get_action('package_create_rest')(dict(context), package_dict)
+                    except ValidationError, e:
+                        # another writer may have taken the name since it was generated
+                        new_name = 'name' in e.error_dict and self._name_conflict(package_dict, harvest_object)
+                        if not new_name:
+                            raise
+                        log.info('Name %s of package with GUID %s is taken, retrying as %s'
+                                 % (package_dict['name'], harvest_object.guid, new_name))
+                        package_dict['name'] = new_name
+                        new_package = get_action('package_create_rest')(context, package_dict)
 
-            Session.commit()
+            if self._chunk is None:
+                metrics.incr('db.commits')
+                Session.commit()
+
+            self._index_package(new_package['id'], new_package['name'],
+                                new_package.get('metadata_modified'))
+
+            # With deferred indexing the package is reindexed later in a batch
+            if written and self._chunk is not None:
+                self._chunk['written'].append(new_package['id'])
+            elif written and deferred_indexer.active:
+                deferred_indexer.touch(new_package['id'])
 
             return True
 
         except ValidationError,e:
+            if self._chunk is not None:
+                # the whole chunk is imported again one by one
+                raise
             log.exception(e)
             self._save_object_error('Invalid package with GUID %s: %r'%(harvest_object.guid,e.error_dict),harvest_object,'Import')
         except Exception, e:
+            if self._chunk is not None:
+                raise
             log.exception(e)
             self._save_object_error('%r'%e,harvest_object,'Import')
+        harvest_object.report_status = u'errored'
 
         return None
@@ -0,0 +1,165 @@
+# coding: utf-8
+
+import random
+import sqlite3
+import threading
+import time
+
+import logging
+log = logging.getLogger(__name__)
+
+# raised by the cache methods, e.g. if the database stays locked
+CacheError = sqlite3.Error
+
+_caches = {}
+_lock = threading.Lock()
+
+# the access time of an entry is only updated when it is older than this
+# share of the TTL, and then with the others in a batch of updates
+ACCESS_PRECISION = 0.1
+ACCESS_BATCH = 1000
+
+
+class AvailabilityCache(object):
+    '''
+    On-disk (SQLite) cache of the availability of resource URLs
+
+    Every entry stores the HTTP status, the validators (ETag and
+    Last-Modified) of the last response, when it was checked and for
+    how long it is valid. Expired entries are kept until they are
+    evicted so they can be revalidated with a conditional request.
+
+    Every write is committed right away and the database is used in WAL
+    mode, so that several processes (e.g. a gather and a link check) can
+    use the same cache without holding its write lock for a whole run.
+    Lookups only read: the access times (for the eviction) are written in
+    batches, at the latest by evict() and flush().
+    '''
+
+    def __init__(self, path, ttl=7 * 24 * 3600, error_ttl=3600,
+                 max_entries=100000, timeout=30):
+        self.path = path
+        self.ttl = ttl
+        self.error_ttl = error_ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._accessed = {}
+        self.conn = sqlite3.connect(
+            path,
+            timeout=timeout,
+            check_same_thread=False
+        )
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS availability ('
+            'url TEXT PRIMARY KEY, status INTEGER, etag TEXT, '
+            'last_modified TEXT, checked REAL, ttl REAL, accessed REAL)'
+        )
+        self.conn.commit()
+
+    def get(self, url):
+        '''
+        Return the entry for url as a dict (or None if there is none)
+        '''
+        now = time.time()
+        with self._lock:
+            row = self.conn.execute(
+                'SELECT status, etag, last_modified, checked, ttl, accessed '
+                'FROM availability WHERE url = ?', (url,)
+            ).fetchone()
+            if row is None:
+                return None
+            status, etag, last_modified, checked, ttl, accessed = row
+            if accessed < now - self.ttl * ACCESS_PRECISION:
+                self._accessed[url] = now
+                if len(self._accessed) >= ACCESS_BATCH:
+                    self._write_accessed()
+        return {
+            'status': status,
+            'etag': etag,
+            'last_modified': last_modified,
+            'fresh': checked + ttl > now
+        }
+
+    def _write_accessed(self):
+        '''
+        Write the collected access times (with the lock held)
+        '''
+        if not self._accessed:
+            return
+        self.conn.executemany(
+            'UPDATE availability SET accessed = ? WHERE url = ?',
+            [(accessed, url) for url, accessed in self._accessed.items()]
+        )
+        self.conn.commit()
+        self._accessed = {}
+
+    def set(self, url, status, etag=None, last_modified=None):
+        '''
+        Store the result of a request to url
+
+        Successful results are kept for a random share (50-100%) of the
+        TTL, so that not all entries expire in the same harvest run.
+        '''
+        if status == 200:
+            ttl = self.ttl * random.uniform(0.5, 1.0)
+        else:
+            ttl = self.error_ttl
+        now = time.time()
+        with self._lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO availability '
+                '(url, status, etag, last_modified, checked, ttl, accessed) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (url, status, etag, last_modified, now, ttl, now)
+            )
+            self.conn.commit()
+
+    def revalidated(self, url):
+        '''
+        Mark the entry for url as fresh again (e.g. after a 304)
+        '''
+        now = time.time()
+        with self._lock:
+            self.conn.execute(
+                'UPDATE availability SET checked = ?, accessed = ? '
+                'WHERE url = ?', (now, now, url)
+            )
+            self.conn.commit()
+
+    def evict(self, max_age=None):
+        '''
+        Remove entries not used for max_age seconds (default: twice the
+        TTL) and the least recently used ones above max_entries
+        '''
+        if max_age is None:
+            max_age = 2 * self.ttl
+        with self._lock:
+            self._write_accessed()
+            self.conn.execute(
+                'DELETE FROM availability WHERE accessed < ?',
+                (time.time() - max_age,)
+            )
+            self.conn.execute(
+                'DELETE FROM availability WHERE url IN ('
+                'SELECT url FROM availability ORDER BY accessed DESC '
+                'LIMIT -1 OFFSET ?)', (self.max_entries,)
+            )
+            self.conn.commit()
+
+    def flush(self):
+        with self._lock:
+            self._write_accessed()
+            self.conn.commit()
+
+
+def get_cache(path, **kwargs):
+    '''
+    Return the availability cache stored at path (one per process)
+    '''
+    with _lock:
+        if path not in _caches:
+            log.debug('Opening availability cache %s' % path)
+            _caches[path] = AvailabilityCache(path, **kwargs)
+        return _caches[path]
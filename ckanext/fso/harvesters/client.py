@@ -0,0 +1,91 @@
+# coding: utf-8
+
+import threading
+import urllib3
+
+import logging
+log = logging.getLogger(__name__)
+
+# default settings, each one can be overridden in the harvest source
+# config with the same key prefixed by 'http_' (e.g. 'http_pool_size')
+DEFAULTS = {
+    'pool_size': 4,
+    'keep_alive': True,
+    'connect_timeout': 10.0,
+    'read_timeout': 30.0,
+    'retries': 3,
+    'backoff_factor': 0.5
+}
+RETRY_STATUSES = [500, 502, 503, 504]
+
+_clients = {}
+_lock = threading.Lock()
+
+
+class HttpClient(object):
+    '''
+    A pooled HTTP client shared by all fetchers of the extension
+
+    At most `pool_size` connections are opened per host, requests
+    block until one of them is free again.
+    '''
+
+    def __init__(self, pool_size, keep_alive, connect_timeout,
+                 read_timeout, retries, backoff_factor):
+        if keep_alive:
+            headers = urllib3.make_headers(keep_alive=True)
+        else:
+            headers = {'connection': 'close'}
+
+        self.pool = urllib3.PoolManager(
+            maxsize=int(pool_size),
+            block=True,
+            headers=headers,
+            timeout=urllib3.Timeout(
+                connect=float(connect_timeout),
+                read=float(read_timeout)
+            ),
+            retries=urllib3.Retry(
+                total=int(retries),
+                backoff_factor=float(backoff_factor),
+                status_forcelist=RETRY_STATUSES
+            )
+        )
+
+    def request(self, method, url, headers=None, **kwargs):
+        '''
+        Send a request, headers are added to the default headers
+        '''
+        request_headers = dict(self.pool.headers)
+        request_headers.update(headers or {})
+        return self.pool.request(
+            method, url, headers=request_headers, **kwargs
+        )
+
+
+def client_settings(config=None):
+    '''
+    Return the client settings of a harvest source config
+    '''
+    config = config or {}
+    settings = dict(DEFAULTS)
+    for key in DEFAULTS:
+        if 'http_' + key in config:
+            settings[key] = config['http_' + key]
+    return settings
+
+
+def get_client(config=None):
+    '''
+    Return the shared client for the given harvest source config
+
+    Clients are created once per process and settings, so all requests
+    with the same config reuse the same connection pools.
+    '''
+    settings = client_settings(config)
+    key = tuple(sorted(settings.items()))
+    with _lock:
+        if key not in _clients:
+            log.debug('Creating HTTP client with %r' % settings)
+            _clients[key] = HttpClient(**settings)
+        return _clients[key]
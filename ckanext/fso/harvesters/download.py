@@ -0,0 +1,84 @@
+# coding: utf-8
+
+import os
+import json
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class MetadataFile(object):
+    '''
+    The local copy of the metadata file of a harvest source and the
+    validators (ETag, Last-Modified) of the download it comes from
+    '''
+
+    def __init__(self, directory, name):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.path = os.path.join(directory, name + '.xml')
+        self.state_path = self.path + '.json'
+        self._tmp_path = self.path + '.tmp'
+
+    def validators(self):
+        '''
+        Returns the validators of the last successful download
+        '''
+        if not os.path.exists(self.state_path):
+            return {}
+        try:
+            with open(self.state_path) as state_file:
+                return json.load(state_file)
+        except ValueError:
+            log.warning('Ignoring invalid state file %s' % self.state_path)
+            return {}
+
+    def conditional_headers(self):
+        '''
+        Returns the headers for a conditional request of the file
+        '''
+        validators = self.validators()
+        headers = {}
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+        return headers
+
+    def reader(self, response):
+        '''
+        Returns a file-like object reading the response body, which
+        writes everything it reads to the local copy
+        '''
+        return _TeeReader(response, open(self._tmp_path, 'wb'))
+
+    def save(self, response):
+        '''
+        Replace the local copy with the downloaded file and remember
+        the validators of the response
+        '''
+        os.rename(self._tmp_path, self.path)
+        with open(self.state_path, 'w') as state_file:
+            json.dump({
+                'etag': response.getheader('etag'),
+                'last_modified': response.getheader('last-modified')
+            }, state_file)
+
+
+class _TeeReader(object):
+    def __init__(self, source, target):
+        self.source = source
+        self.target = target
+        self.size = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = self.source.read()
+        else:
+            data = self.source.read(size)
+        self.target.write(data)
+        self.size += len(data)
+        return data
+
+    def close(self):
+        self.target.close()
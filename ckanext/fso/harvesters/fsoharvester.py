@@ -1,18 +1,32 @@
 #coding: utf-8
 
 import os
-import urllib3
+import re
+import hashlib
+import datetime
+import tempfile
+import time
 from lxml import etree
+from pylons import config as pylons_config
+from sqlalchemy.sql import and_, bindparam
 from uuid import NAMESPACE_OID, uuid4, uuid5
 
 from ckan import model
-from ckan.model import Session, Package
-from ckan.logic import get_action, action
+from ckan.model import Session
+from ckan.logic import get_action, NotFound
 from ckan.lib.helpers import json
 from ckan.lib.munge import munge_title_to_name
 
-from ckanext.harvest.model import HarvestObject
+from ckanext.harvest.model import HarvestJob, HarvestObject
+from ckanext.harvest.model import HarvestObjectExtra
 from base import OGDCHHarvesterBase
+from cache import get_cache
+from client import get_client
+from download import MetadataFile
+from metrics import metrics, metrics_settings
+from payload import encode_content, decode_content
+from probe import ResourceProber, head_status
+from record import package_records
 
 import logging
 log = logging.getLogger(__name__)
@@ -215,6 +229,18 @@ class FSOHarvester(OGDCHHarvesterBase):
             'inquiry_period': u'Inquiry period'
         }
     }
+    # bump to invalidate all fingerprints when the generated metadata
+    # changes for an unchanged metadata file
+    FINGERPRINT_VERSION = 2
+    # group codes in the order of GROUPS
+    GROUP_CODES = ['01', '17', '00', '14']
+    # topic of the NOTES_HELPERS links by group code
+    NOTES_TOPICS = {
+        '01': 'population',
+        '17': 'politics',
+        '14': 'health',
+        '00': 'basis'
+    }
     PUBLISHED_AT = {
         'de': u'Veröffentlicht:',
         'fr': u'Publié:',
@@ -223,9 +249,40 @@ class FSOHarvester(OGDCHHarvesterBase):
     }
 
     config = {
-        'user': u'admin'
+        'user': u'admin',
+        'probe_workers': 8,
+        'probe_per_host': 4,
+        'probe_rate': None,
+        'probe_batch_size': 200,
+        'gather_batch_size': 100,
+        'incremental': True,
+        'direct_import': False,
+        'compress_content': False,
+        'availability_cache_ttl': 7 * 24 * 3600
     }
 
+    # availability of the resource URLs, filled by _probe_resources
+    _availability = {}
+
+    # see _generate_static_term_translations
+    _static_translations = None
+
+    # see _munge_name
+    _munged_names = {}
+
+    # group and organization ids of the current job, see _get_or_create
+    _entity_ids = {}
+    _entity_ids_jobs = set()
+
+    def _set_config(self, config_str):
+        '''
+        Merge the (JSON) config of the harvest source into the defaults
+        '''
+        config = dict(FSOHarvester.config)
+        if config_str:
+            config.update(json.loads(config_str))
+        self.config = config
+
     def _create_uuid(self, name=None):
         '''
         Create a new SHA-1 uuid for a given name or a random id
@@ -237,187 +294,342 @@ class FSOHarvester(OGDCHHarvesterBase):
 
         return unicode(new_uuid)
 
-    def _gen_new_name(self, title, current_id=None):
+    def _munge_name(self, title):
+        '''
+        Creates a URL friendly name from a title (memoized)
+        '''
+        if title not in self._munged_names:
+            name = munge_title_to_name(title).replace('_', '-')
+            self._munged_names[title] = re.sub('-{2,}', '-', name)
+        return self._munged_names[title]
+
+    def _gen_new_name(self, title, current_id=None, job_id=None,
+                      recheck=False):
         '''
         Creates a URL friendly name from a title
 
-        If the name already exists, it will add some
-        random characters at the end
+        If the name already exists, it will add the first characters
+        of the package id at the end (or random ones if there is no id).
+        With recheck, names missing in the name index are looked up in
+        the database too.
         '''
+        name = self._munge_name(title)
+        with self._cache_lock:
+            names = self._get_name_index(job_id)
+            owner = self._name_owner(name, names, current_id, recheck)
+            if owner == current_id:
+                return name
 
-        name = munge_title_to_name(title).replace('_', '-')
-        while '--' in name:
-            name = name.replace('--', '-')
-        pkg_obj = Session.query(Package).filter(Package.name == name).first()
-        if pkg_obj and pkg_obj.id != current_id:
-            return name + str(uuid4())[:5]
-        else:
-            return name
+            suffix = current_id[:5] if current_id else str(uuid4())[:5]
+            new_name = name + suffix
+            counter = 1
+            while self._name_owner(new_name, names, current_id,
+                                   recheck) != current_id:
+                counter += 1
+                new_name = '%s%s%d' % (name, suffix, counter)
+            return new_name
+
+    def _name_owner(self, name, names, default=None, recheck=False):
+        '''
+        Returns the id of the package with the given name, or default if
+        there is none
+
+        With recheck, names missing in the name index are looked up in
+        the database, they may have been taken by another process (e.g.
+        an import worker) after the index was loaded.
+        '''
+        if name not in names:
+            if not recheck:
+                return default
+            owner = Session.query(model.Package.id) \
+                .filter(model.Package.name == name) \
+                .first()
+            if owner is None:
+                return default
+            names[name] = owner[0]
+        return names[name]
+
+    def _name_conflict(self, package_dict, harvest_object):
+        '''
+        Returns a new name for a package which could not be created
+        because its name was taken in the meantime
+
+        Only then the candidates are checked against the database, as
+        other writers may have taken more names.
+        '''
+        with self._cache_lock:
+            names = self._get_name_index(harvest_object.harvest_job_id)
+            # taken by a package this process does not know about
+            names[package_dict['name']] = None
+            return self._gen_new_name(
+                package_dict['datasetID'],
+                package_dict['id'],
+                harvest_object.harvest_job_id,
+                recheck=True
+            )
+
+    def _cache_dir(self):
+        '''
+        Returns the directory for the local files of the harvester
+        '''
+        return pylons_config.get('cache_dir', tempfile.gettempdir())
+
+    def _availability_cache(self):
+        '''
+        Returns the availability cache of the harvest source,
+        None if it is disabled (availability_cache set to false)
+        '''
+        path = self.config.get('availability_cache', os.path.join(
+            self._cache_dir(),
+            'fso_availability.db'
+        ))
+        if not path:
+            return None
+        return get_cache(path, ttl=self.config['availability_cache_ttl'])
 
     def _file_is_available(self, url):
         '''
         Returns true if 200, False otherwise. (logs falses)
+
+        Fresh results are taken from the availability cache, expired
+        ones are revalidated with a conditional request.
         '''
-        status = urllib3.PoolManager().request('HEAD', url).status
+        status, cached = head_status(
+            url,
+            get_client(self.config),
+            self._availability_cache()
+        )
         if status == 200:
             return True
         else:
             log.debug(str(status) + ': ' + url)
             return False
 
+    def _probe_resources(self, packages):
+        '''
+        Check the availability of all resources of the given packages
+        concurrently, before any metadata is generated
+        '''
+        urls = [
+            url.text
+            for package in packages
+            for url in package.iterfind('dataset/resource/url')
+        ]
+        prober = ResourceProber(
+            self._file_is_available,
+            workers=self.config.get('probe_workers', 8),
+            per_host=self.config.get('probe_per_host', 4),
+            rate=self.config.get('probe_rate')
+        )
+        self._availability = prober.probe(urls)
+
+    def _resource_is_available(self, url):
+        '''
+        Look up the probed availability of a resource, or check it now
+        '''
+        if url in self._availability:
+            return self._availability[url]
+        return self._file_is_available(url)
+
+    def _iter_package_batches(self, source, size):
+        '''
+        Parse the metadata file incrementally and yield lists of up to
+        size <package> elements
+
+        A batch is cleared (together with everything parsed before it)
+        as soon as the next one is requested, so only one batch is kept
+        in memory at a time.
+        '''
+        batch = []
+        for _, package in etree.iterparse(
+                source, tag='package', encoding='utf-8'):
+            batch.append(package)
+            if len(batch) >= size:
+                yield batch
+                self._release_packages(batch)
+                batch = []
+        if batch:
+            yield batch
+
+    def _release_packages(self, packages):
+        '''
+        Free the memory of processed <package> elements
+        '''
+        for package in packages:
+            package.clear()
+        last = packages[-1]
+        while last.getprevious() is not None:
+            del last.getparent()[0]
+
+    def _fingerprint(self, package):
+        '''
+        Returns a stable fingerprint of a <package> element (canonical
+        XML) and the availability of its resources
+        '''
+        digest = hashlib.sha1(str(self.FINGERPRINT_VERSION))
+        digest.update(etree.tostring(package, method='c14n'))
+        urls = sorted(
+            url.text for url in package.iterfind('dataset/resource/url')
+            if url.text
+        )
+        for url in urls:
+            available = self._resource_is_available(url)
+            digest.update('\n%s %s' % (url.encode('utf-8'), available))
+        return digest.hexdigest()
+
+    def _current_fingerprints(self, source_id):
+        '''
+        Returns the fingerprints of the current harvest objects
+        of a harvest source by guid
+        '''
+        query = Session.query(HarvestObject.guid, HarvestObjectExtra.value)
+        query = query.join(
+            HarvestObjectExtra,
+            HarvestObjectExtra.harvest_object_id == HarvestObject.id
+        ).join(
+            HarvestJob,
+            HarvestObject.harvest_job_id == HarvestJob.id
+        ).filter(
+            HarvestJob.source_id == source_id,
+            HarvestObject.current == True,  # noqa
+            HarvestObjectExtra.key == 'fingerprint'
+        )
+        return dict(query)
+
     def _generate_tags_array(self, dataset):
         '''
         All tags for a dataset into an array
         '''
-        tags = []
-        for tag in dataset.find('tags').findall('tag'):
-            tags.append(tag.text)
-        return tags
+        return list(dataset.tags)
 
     def _get_dataset_group(self, dataset):
         '''
         Get group name based on the policy discussed with the FSO
         '''
-        for group_tag in dataset.find('groups').findall('group'):
-            if group_tag.text[0:2] == "01":
-                return self.GROUPS['de'][0]
-            if group_tag.text[0:2] == "17":
-                return self.GROUPS['de'][1]
-            if group_tag.text[0:2] == "00":
-                return self.GROUPS['de'][2]
-            if group_tag.text[0:2] == "14":
-                return self.GROUPS['de'][3]
+        for group_code in dataset.group_codes:
+            if group_code in self.GROUP_CODES:
+                return self.GROUPS['de'][self.GROUP_CODES.index(group_code)]
         return None
 
     def _generate_notes(self, dataset, key):
         '''
         Concatenates all the notes pieces together into a single notes string
         '''
-        if dataset.find('notes').text:
-            notes = dataset.find('notes').text
-        else:
-            notes = ''
+        helpers = self.NOTES_HELPERS[key]
+        notes = dataset.notes or ''
 
-        if dataset.find('coverage').text:
+        if dataset.coverage:
             notes += (
                 '\n  ' +
-                self.NOTES_HELPERS[key]['inquiry_period'] + ' ' +
-                dataset.find('coverage').text
+                helpers['inquiry_period'] + ' ' +
+                dataset.coverage
             )
 
         # Published At -> Notes
-        if dataset.find('published').text:
+        if dataset.published:
             notes += (
                 '\n  ' +
                 self.PUBLISHED_AT[key] + ' ' +
-                dataset.find('published').text
+                dataset.published
             )
 
         # More Information -> Notes
-        if dataset.find('groups').find('group').text[0:2] == "01":
+        topic = self.NOTES_TOPICS.get(dataset.group_prefix)
+        if topic:
             notes += (
                 '\n  ' +
-                "[" + self.NOTES_HELPERS[key]['link_text_to_fso_population'] +
-                "](" + self.NOTES_HELPERS[key]['link_to_fso_population'] + ")"
+                "[" + helpers['link_text_to_fso_' + topic] +
+                "](" + helpers['link_to_fso_' + topic] + ")"
             )
+        else:
+            log.debug(dataset.group_prefix)
 
-        if dataset.find('groups').find('group').text[0:2] == "17":
-            notes += (
-                '\n  ' +
-                "[" + self.NOTES_HELPERS[key]['link_text_to_fso_politics'] +
-                "](" + self.NOTES_HELPERS[key]['link_to_fso_politics'] + ")"
-            )
+        return notes
 
-        if dataset.find('groups').find('group').text[0:2] == "14":
-            notes += (
-                '\n  ' +
-                "[" + self.NOTES_HELPERS[key]['link_text_to_fso_health'] +
-                "](" + self.NOTES_HELPERS[key]['link_to_fso_health'] + ")"
-            )
+    def _generate_static_term_translations(self):
+        '''
+        Return the term_translations of the groups and the organization
 
-        if dataset.find('groups').find('group').text[0:2] == "00":
-            notes += (
-                '\n  ' +
-                "[" + self.NOTES_HELPERS[key]['link_text_to_fso_basis'] +
-                "](" + self.NOTES_HELPERS[key]['link_to_fso_basis'] + ")"
-            )
+        They are the same for every dataset, so they are only generated
+        once per process and written once per harvest job.
+        '''
+        if FSOHarvester._static_translations is None:
+            translations = []
 
-        else:
-            log.debug(dataset.find('groups').find('group').text[0:2])
+            # term translations for the groups (finite set)
+            for key, lang in self.GROUPS.iteritems():
+                for idx, group in enumerate(self.GROUPS[key]):
+                    translations.append({
+                        'lang_code': key,
+                        'term': self.GROUPS['de'][idx],
+                        'term_translation': group
+                        })
 
-        return notes
+            for lang, org in self.ORGANIZATION.items():
+                if lang != 'de':
+                    for field in ['name', 'description']:
+                        translations.append({
+                            'lang_code': lang,
+                            'term': self.ORGANIZATION['de'][field],
+                            'term_translation': org[field]
+                        })
+
+            FSOHarvester._static_translations = translations
+        return FSOHarvester._static_translations
 
-    def _generate_term_translations(self, base_dataset, package):
+    def _generate_term_translations(self, base_dataset, datasets,
+                                    base_notes=None):
         '''
-        Return all the term_translations for a given dataset
+        Return the dataset specific term_translations for a given dataset
+
+        The notes of every language are generated exactly once and
+        translate the (german) notes of the base dataset, which can be
+        passed in as base_notes if they are already known.
         '''
         translations = []
+        if base_notes is None:
+            base_notes = self._generate_notes(base_dataset, 'de')
 
-        # term translations for the groups (finite set)
-        for key, lang in self.GROUPS.iteritems():
-            for idx, group in enumerate(self.GROUPS[key]):
-                translations.append({
-                    'lang_code': key,
-                    'term': self.GROUPS['de'][idx],
-                    'term_translation': group
-                    })
-
-        for lang, org in self.ORGANIZATION.items():
-            if lang != 'de':
-                for field in ['name', 'description']:
-                    translations.append({
-                        'lang_code': lang,
-                        'term': self.ORGANIZATION['de'][field],
-                        'term_translation': org[field]
-                    })
-
-        for dataset in package:
-            if base_dataset.get('datasetID') != dataset.get('datasetID'):
-                lang = dataset.get(
-                    '{http://www.w3.org/XML/1998/namespace}lang'
-                )
+        for dataset in datasets:
+            if base_dataset.dataset_id != dataset.dataset_id:
+                lang = dataset.lang
                 keys = ['title', 'author', 'maintainer']
                 for key in keys:
-                    if base_dataset.find(key).text and dataset.find(key).text:
+                    term = getattr(base_dataset, key)
+                    term_translation = getattr(dataset, key)
+                    if term and term_translation:
                         translations.append({
                             'lang_code': lang,
-                            'term': base_dataset.find(key).text,
-                            'term_translation': dataset.find(key).text
+                            'term': term,
+                            'term_translation': term_translation
                             })
 
-                for lang in self.NOTES_HELPERS:
-                    if lang != 'de':
-                        base_notes_translation = self._generate_notes(
-                            base_dataset,
-                            'de'
-                        )
-                        other_notes_translation = self._generate_notes(
+                if lang != 'de' and lang in self.NOTES_HELPERS:
+                    translations.append({
+                        'lang_code': lang,
+                        'term': base_notes,
+                        'term_translation': self._generate_notes(
                             dataset,
                             lang
                         )
-                        translations.append({
-                            'lang_code': lang,
-                            'term': base_notes_translation,
-                            'term_translation': other_notes_translation
-                            })
+                        })
 
         return translations
 
-    def _generate_resources(self, package):
+    def _generate_resources(self, datasets):
         '''
         Return all resources for a given package
         that return a HTTP Status of 200
         '''
         resources = []
-        for dataset in package:
-            resource_url = dataset.find('resource').find('url').text
-            resource_name = dataset.find('resource').find('name').text
-            if self._file_is_available(resource_url):
-                resources.append({
-                    'url': dataset.find('resource').find('url').text,
-                    'name': dataset.find('resource').find('name').text,
-                    'format': self._guess_format(resource_name)
-                    })
+        with metrics.timer('gather.resources'):
+            for dataset in datasets:
+                if self._resource_is_available(dataset.resource_url):
+                    resources.append({
+                        'url': dataset.resource_url,
+                        'name': dataset.resource_name,
+                        'format': self._guess_format(dataset.resource_name)
+                        })
         return resources
 
     def _guess_format(self, file_name):
@@ -427,27 +639,29 @@ class FSOHarvester(OGDCHHarvesterBase):
             _, file_extension = os.path.splitext(file_name.lower())
             return file_extension[1:]
 
-    def _generate_metadata(self, base_dataset, package):
+    def _generate_metadata(self, base_dataset, datasets):
         '''
         Return all the necessary metadata to be able to create a dataset
         '''
-        resources = self._generate_resources(package)
+        resources = self._generate_resources(datasets)
         group = self._get_dataset_group(base_dataset)
 
         if len(resources) != 0 and group:
+            notes = self._generate_notes(base_dataset, 'de')
             translations = self._generate_term_translations(
                 base_dataset,
-                package
+                datasets,
+                notes
             )
             return {
-                'datasetID': base_dataset.get('datasetID'),
-                'title': base_dataset.find('title').text,
-                'notes': self._generate_notes(base_dataset, 'de'),
-                'author': base_dataset.find('author').text,
-                'maintainer': base_dataset.find('maintainer').text,
-                'maintainer_email': base_dataset.find('maintainer_email').text,
-                'license_url': base_dataset.find('licence').text,
-                'license_id': base_dataset.find('copyright').text,
+                'datasetID': base_dataset.dataset_id,
+                'title': base_dataset.title,
+                'notes': notes,
+                'author': base_dataset.author,
+                'maintainer': base_dataset.maintainer,
+                'maintainer_email': base_dataset.maintainer_email,
+                'license_url': base_dataset.licence,
+                'license_id': base_dataset.copyright,
                 'translations': translations,
                 'resources': resources,
                 'tags': self._generate_tags_array(base_dataset),
@@ -456,6 +670,124 @@ class FSOHarvester(OGDCHHarvesterBase):
         else:
             return None
 
+    def _write_term_translations(self, translations):
+        '''
+        Add the translations to the term_translations table
+
+        All of them are upserted with one (executemany) delete and
+        insert instead of one term_translation_update call each. In a
+        chunk they are collected and written together at its end (see
+        _finish_chunk).
+        '''
+        if self._chunk is not None:
+            rows = self._chunk.setdefault('translations', {})
+        else:
+            rows = {}
+        for translation in translations:
+            if not (translation['term'] and
+                    translation['term_translation'] and
+                    translation['lang_code']):
+                continue
+            key = (translation['term'], translation['lang_code'])
+            rows[key] = {
+                'b_term': translation['term'],
+                'b_term_translation': translation['term_translation'],
+                'b_lang_code': translation['lang_code']
+            }
+        if self._chunk is None and rows:
+            self._save_term_translations(rows)
+            metrics.incr('db.commits')
+            Session.commit()
+
+    def _finish_chunk(self):
+        '''
+        Write the translations of the chunk
+
+        Author and maintainer terms are shared by many datasets: they are
+        written once per chunk and right before the commit, so that the
+        row locks of concurrent workers are only held briefly, and in the
+        same (sorted) order, so that the workers do not deadlock.
+        '''
+        self._save_term_translations(self._chunk.get('translations', {}))
+
+    def _save_term_translations(self, rows):
+        if not rows:
+            return
+
+        rows = [rows[key] for key in sorted(rows)]
+        metrics.incr('db.term_translation_rows', len(rows))
+        table = model.term_translation_table
+        with metrics.timer('db.term_translations'):
+            conn = Session.connection()
+            conn.execute(
+                table.delete().where(and_(
+                    table.c.term == bindparam('b_term'),
+                    table.c.lang_code == bindparam('b_lang_code')
+                )),
+                rows
+            )
+            conn.execute(
+                table.insert().values(
+                    term=bindparam('b_term'),
+                    term_translation=bindparam('b_term_translation'),
+                    lang_code=bindparam('b_lang_code')
+                ),
+                rows
+            )
+
+    def _get_or_create(self, entity_type, data_dict, context, job_id):
+        '''
+        Returns the id of a group or organization, which is created if it
+        does not exist yet
+
+        The ids are cached for the harvest job (or import run), the cache
+        is dropped as soon as an object of a new job is imported. It is
+        locked while an entity is looked up, so that concurrent imports
+        do not create it twice.
+        '''
+        with self._cache_lock:
+            if self._job_caches_stale(FSOHarvester._entity_ids_jobs, job_id):
+                FSOHarvester._entity_ids = {}
+                FSOHarvester._entity_ids_jobs = \
+                    FSOHarvester._entity_ids_jobs | set([job_id])
+
+            entity_ids = FSOHarvester._entity_ids
+            key = (entity_type, data_dict['id'])
+            if key not in entity_ids:
+                try:
+                    with metrics.timer('action.%s_show' % entity_type):
+                        entity = get_action(entity_type + '_show')(
+                            context,
+                            data_dict
+                        )
+                    log.info('found the %s %s' % (entity_type, entity['id']))
+                except NotFound:
+                    with metrics.timer('action.%s_create' % entity_type):
+                        entity = get_action(entity_type + '_create')(
+                            context,
+                            data_dict
+                        )
+                    log.info(
+                        'created the %s %s' % (entity_type, entity['id'])
+                    )
+                entity_ids[key] = entity['id']
+            return entity_ids[key]
+
+    def _start_metrics(self, job_id):
+        '''
+        Collect the metrics of the harvest job if ckanext.fso.metrics
+        is enabled
+        '''
+        enabled, directory, textfile = metrics_settings()
+        if enabled:
+            metrics.start(job_id, directory, textfile)
+
+    def _reset_job_caches(self):
+        with self._cache_lock:
+            super(FSOHarvester, self)._reset_job_caches()
+            FSOHarvester._entity_ids = {}
+            FSOHarvester._entity_ids_jobs = set()
+
     def info(self):
         return {
             'name': 'fso',
@@ -466,57 +798,188 @@ class FSOHarvester(OGDCHHarvesterBase):
 
     def gather_stage(self, harvest_job):
         log.debug('In FSOHarvester gather_stage')
+        self._set_config(harvest_job.source.config)
+        self._start_metrics(harvest_job.id)
+        try:
+            with metrics.timer('gather'):
+                return self._gather(harvest_job)
+        finally:
+            metrics.flush()
+
+    def _gather(self, harvest_job):
+        local_file = MetadataFile(
+            os.path.join(self._cache_dir(), 'fso_metadata'),
+            harvest_job.source_id
+        )
+        headers = {'Accept-Encoding': 'gzip'}
+        if self.config['incremental']:
+            headers.update(local_file.conditional_headers())
+
+        http = get_client(self.config)
+        with metrics.timer('gather.request'):
+            metadata_file = http.request(
+                'GET',
+                self.METADATA_URL,
+                headers=headers,
+                preload_content=False
+            )
+        if metadata_file.status == 304:
+            log.info('Metadata file not modified since the last harvest')
+            metrics.incr('gather.not_modified')
+            metadata_file.release_conn()
+            return []
+        if metadata_file.status != 200:
+            metadata_file.release_conn()
+            self._save_gather_error(
+                'Unable to get the metadata file (HTTP %s)'
+                % metadata_file.status,
+                harvest_job
+            )
+            return None
 
-        http = urllib3.PoolManager()
-        metadata_file = http.request('GET', self.METADATA_URL)
+        # The group and organization translations are written once for
+        # the whole job instead of with every dataset
+        self._write_term_translations(
+            self._generate_static_term_translations()
+        )
+
+        if self.config['incremental']:
+            fingerprints = self._current_fingerprints(harvest_job.source_id)
+        else:
+            fingerprints = {}
 
         ids = []
-        parser = etree.XMLParser(encoding='utf-8')
-        for package in etree.fromstring(metadata_file.data, parser=parser):
-
-            # Get the german dataset if one is available
-            # otherwise get the first one
-            base_datasets = package.xpath("dataset[@xml:lang='de']")
-            if len(base_datasets) != 0:
-                base_dataset = base_datasets[0]
-            else:
-                base_dataset = package.find('dataset')
-
-            metadata = self._generate_metadata(base_dataset, package)
-            if metadata:
-                obj = HarvestObject(
-                    guid=self._create_uuid(base_dataset.get('datasetID')),
-                    job=harvest_job,
-                    content=json.dumps(metadata)
-                )
-                obj.save()
-                log.debug(
-                    'adding %s to the queue' % base_dataset.get('datasetID')
-                )
-                ids.append(obj.id)
-            else:
-                log.debug(
-                    'Skipping %s since no resources or groups are available'
-                    % base_dataset.get('datasetID')
+        pending = []
+        reader = local_file.reader(metadata_file)
+        # the file is downloaded while it is parsed
+        batches = metrics.timed_iter(
+            'gather.download_parse',
+            self._iter_package_batches(
+                reader,
+                int(self.config['probe_batch_size'])
+            )
+        )
+        for packages in batches:
+            with metrics.timer('gather.probe'):
+                self._probe_resources(packages)
+            for package in packages:
+                obj = self._gather_package(
+                    package,
+                    harvest_job,
+                    fingerprints
                 )
+                if obj:
+                    pending.append(obj)
+                if len(pending) >= int(self.config['gather_batch_size']):
+                    ids.extend(self._save_objects(pending))
+                    pending = []
+        ids.extend(self._save_objects(pending))
+        if self.config['direct_import']:
+            # all objects have been imported already, nothing to queue
+            ids = []
+        reader.close()
+        metadata_file.release_conn()
+        local_file.save(metadata_file)
+        metrics.incr('gather.download_bytes', reader.size)
+
+        cache = self._availability_cache()
+        if cache:
+            cache.evict()
+
+        return ids
 
+    def _save_objects(self, objs):
+        '''
+        Save a batch of harvest objects in one transaction and return
+        their ids (and import them with direct_import enabled)
+        '''
+        if not objs:
+            return []
+        with metrics.timer('gather.save_objects'):
+            Session.flush()
+            ids = [obj.id for obj in objs]
+            metrics.incr('db.commits')
+            Session.commit()
+        metrics.incr('gather.objects', len(objs))
+
+        if self.config['direct_import']:
+            self._import_objects(objs)
         return ids
 
+    def _import_objects(self, objs):
+        '''
+        Import gathered objects right away instead of sending them
+        through the fetch queue (the fetch stage has nothing to fetch)
+
+        import_chunk sets the state of the objects (COMPLETE or ERROR),
+        so that the job is marked as finished like a queued one.
+        '''
+        now = datetime.datetime.now()
+        for obj in objs:
+            obj.fetch_started = now
+            obj.fetch_finished = now
+            obj.import_started = now
+        self.import_chunk(objs)
+
+        now = datetime.datetime.now()
+        for obj in objs:
+            obj.import_finished = now
+        Session.commit()
+
+    def _gather_package(self, package, harvest_job, fingerprints):
+        '''
+        Create the harvest object for a <package> element, returns None
+        if the package has no resources or group or if its fingerprint
+        matches the one of the current harvest object
+        '''
+        metrics.incr('gather.packages')
+        base_dataset, datasets = package_records(package)
+        if base_dataset is None:
+            return None
+
+        guid = self._create_uuid(base_dataset.dataset_id)
+        fingerprint = self._fingerprint(package)
+        if fingerprints.get(guid) == fingerprint:
+            metrics.incr('gather.unchanged')
+            log.debug(
+                'Skipping %s since it did not change'
+                % base_dataset.dataset_id
+            )
+            return None
+
+        metadata = self._generate_metadata(base_dataset, datasets)
+        if metadata:
+            obj = HarvestObject(
+                guid=guid,
+                job=harvest_job,
+                content=encode_content(
+                    metadata,
+                    self.config['compress_content']
+                ),
+                extras=[
+                    HarvestObjectExtra(key='fingerprint', value=fingerprint)
+                ]
+            )
+            obj.add()
+            log.debug(
+                'adding %s to the queue' % base_dataset.dataset_id
+            )
+            return obj
+        else:
+            log.debug(
+                'Skipping %s since no resources or groups are available'
+                % base_dataset.dataset_id
+            )
+            return None
+
     def fetch_stage(self, harvest_object):
         log.debug('In FSOHarvester fetch_stage')
+        self._start_metrics(harvest_object.harvest_job_id)
+        metrics.incr('fetch.objects')
 
-        # Get the URL
-        datasetID = json.loads(harvest_object.content)['datasetID']
-        log.debug(harvest_object.content)
-
-        # Get contents
-        try:
-            harvest_object.save()
-            log.debug('successfully processed ' + datasetID)
-            return True
-        except Exception, e:
-            log.exception(e)
-            raise
+        # The content is complete after the gather stage already
+        log.debug('successfully processed ' + harvest_object.guid)
+        return True
 
     def import_stage(self, harvest_object):
         log.debug('In FSOHarvester import_stage')
@@ -525,20 +988,25 @@ class FSOHarvester(OGDCHHarvesterBase):
             log.error('No harvest object received')
             return False
 
+        self._start_metrics(harvest_object.harvest_job_id)
+        metrics.incr('import.objects')
+        start = time.time()
         try:
-            package_dict = json.loads(harvest_object.content)
+            package_dict = decode_content(harvest_object.content)
 
             package_dict['id'] = harvest_object.guid
             package_dict['name'] = self._gen_new_name(
                 package_dict['datasetID'],
-                package_dict['id']
+                package_dict['id'],
+                harvest_object.harvest_job_id
             )
 
             user = model.User.get(self.HARVEST_USER)
             context = {
                 'model': model,
                 'session': Session,
-                'user': self.HARVEST_USER
+                'user': self.HARVEST_USER,
+                'defer_commit': self._chunk is not None
                 }
 
             # Find or create group the dataset should get assigned to
@@ -553,38 +1021,35 @@ class FSOHarvester(OGDCHHarvesterBase):
                     'name': munge_title_to_name(group_name),
                     'title': group_name
                     }
-                try:
-                    group = get_action('group_show')(context, data_dict)
-                    log.info('found the group %s' % group['id'])
-                except:
-                    group = get_action('group_create')(context, data_dict)
-                    log.info('created the group ' + group['id'])
+                self._get_or_create(
+                    'group',
+                    data_dict,
+                    context,
+                    harvest_object.harvest_job_id
+                )
 
             # Find or create the organization
             # the dataset should get assigned to
-            try:
-                name = munge_title_to_name(self.ORGANIZATION['de']['name'])
-                data_dict = {
-                    'permission': 'edit_group',
-                    'id': name,
-                    'name': name,
-                    'title': self.ORGANIZATION['de']['name'],
-                    'description': self.ORGANIZATION['de']['description'],
-                    'extras': [
-                        {
-                            'key': 'website',
-                            'value': self.ORGANIZATION['de']['website']
-                        }
-                    ]
-                }
-                org = get_action('organization_show')(context, data_dict)
-                package_dict['owner_org'] = org['id']
-            except:
-                organization = get_action('organization_create')(
-                    context,
-                    data_dict
-                )
-                package_dict['owner_org'] = organization['id']
+            name = munge_title_to_name(self.ORGANIZATION['de']['name'])
+            data_dict = {
+                'permission': 'edit_group',
+                'id': name,
+                'name': name,
+                'title': self.ORGANIZATION['de']['name'],
+                'description': self.ORGANIZATION['de']['description'],
+                'extras': [
+                    {
+                        'key': 'website',
+                        'value': self.ORGANIZATION['de']['website']
+                    }
+                ]
+            }
+            package_dict['owner_org'] = self._get_or_create(
+                'organization',
+                data_dict,
+                context,
+                harvest_object.harvest_job_id
+            )
 
             # Save additional metadata in extras
             extras = []
@@ -600,16 +1065,21 @@ class FSOHarvester(OGDCHHarvesterBase):
                 role=model.Role.ADMIN
             )
 
-            self._create_or_update_package(package_dict, harvest_object)
+            if not self._create_or_update_package(package_dict,
+                                                  harvest_object):
+                # the error has been saved with the object
+                return False
 
             # Add the translations to the term_translations table
-            for translation in package_dict['translations']:
-                action.update.term_translation_update(context, translation)
-            Session.commit()
+            self._write_term_translations(package_dict['translations'])
 
         except Exception, e:
+            metrics.incr('import.errors')
             log.exception(e)
             raise
+        finally:
+            metrics.record('import', time.time() - start)
+            metrics.maybe_flush()
         return True
 
 
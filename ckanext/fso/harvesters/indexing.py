@@ -0,0 +1,81 @@
+# coding: utf-8
+
+from ckan import plugins as p
+from ckan.lib import search
+
+from ckanext.fso.harvesters.metrics import metrics
+
+import logging
+log = logging.getLogger(__name__)
+
+SEARCH_PLUGIN = 'synchronous_search'
+
+
+class DeferredIndexer(object):
+    '''
+    Collects the ids of the packages written by the harvester and
+    reindexes them in batches, with one search commit per batch
+
+    While it is active the synchronous search plugin is unloaded, so
+    package_create/package_update do not index every single package.
+    '''
+
+    def __init__(self):
+        self.active = False
+        self.batch_size = 100
+        self.package_ids = []
+        self._search_plugin_unloaded = False
+
+    def suspend(self, batch_size=100):
+        '''
+        Stop indexing every package synchronously
+        '''
+        self.batch_size = max(1, int(batch_size))
+        if not self.active:
+            try:
+                p.unload(SEARCH_PLUGIN)
+                self._search_plugin_unloaded = True
+            except Exception, e:
+                log.debug('%s not loaded: %r' % (SEARCH_PLUGIN, e))
+            self.active = True
+        log.info(
+            'Search indexing deferred, reindexing in batches of %d'
+            % self.batch_size
+        )
+
+    def touch(self, package_id):
+        '''
+        Remember a package to be reindexed, reindexes the collected
+        packages as soon as there is a full batch
+        '''
+        if package_id not in self.package_ids:
+            self.package_ids.append(package_id)
+        if len(self.package_ids) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        '''
+        Reindex all collected packages
+        '''
+        if not self.package_ids:
+            return
+        log.info('Reindexing %d packages' % len(self.package_ids))
+        metrics.incr('index.packages', len(self.package_ids))
+        with metrics.timer('index.flush'):
+            for package_id in self.package_ids:
+                search.rebuild(package_id, defer_commit=True)
+            search.commit()
+        self.package_ids = []
+
+    def resume(self):
+        '''
+        Reindex the remaining packages and index synchronously again
+        '''
+        self.flush()
+        if self._search_plugin_unloaded:
+            p.load(SEARCH_PLUGIN)
+            self._search_plugin_unloaded = False
+        self.active = False
+
+
+deferred_indexer = DeferredIndexer()
@@ -0,0 +1,128 @@
+# coding: utf-8
+
+import os
+import csv
+import json
+import time
+import datetime
+
+from lxml import etree
+
+from probe import ResourceProber, head_status
+from record import XML_LANG
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class LinkChecker(object):
+    '''
+    Checks the resource URLs of the metadata file concurrently and
+    collects the status and latency of every URL
+
+    Requests are bounded and rate limited like the probing of the
+    harvester (see ResourceProber), fresh results are taken from the
+    availability cache and the results of all requests are stored in it.
+    '''
+
+    FIELDS = [
+        'url', 'status', 'available', 'cached', 'latency', 'error',
+        'datasets'
+    ]
+
+    def __init__(self, client, cache=None, workers=16, per_host=4,
+                 rate=None):
+        self.client = client
+        self.cache = cache
+        self.prober = ResourceProber(
+            self._check,
+            workers=workers,
+            per_host=per_host,
+            rate=rate
+        )
+        self._results = {}
+
+    def _check(self, url):
+        result = {
+            'url': url,
+            'status': None,
+            'available': False,
+            'cached': False,
+            'latency': None,
+            'error': None
+        }
+        start = time.time()
+        try:
+            status, cached = head_status(url, self.client, self.cache)
+            result['status'] = status
+            result['available'] = status == 200
+            result['cached'] = cached
+        except Exception, e:
+            result['error'] = '%r' % e
+        if not result['cached']:
+            result['latency'] = round(time.time() - start, 4)
+        self._results[url] = result
+        return result['available']
+
+    def check(self, links):
+        '''
+        Checks the URLs of (url, dataset id) pairs and returns a result
+        per URL, ordered by URL
+        '''
+        datasets = {}
+        for url, dataset_id in links:
+            if url:
+                datasets.setdefault(url, []).append(dataset_id)
+
+        self._results = {}
+        self.prober.probe(datasets.keys())
+
+        results = []
+        for url in sorted(datasets):
+            result = self._results[url]
+            result['datasets'] = sorted(set(datasets[url]))
+            results.append(result)
+        return results
+
+
+def catalogue_links(source):
+    '''
+    Yields (url, dataset id) for every resource of a metadata file,
+    parsed incrementally
+    '''
+    for _, dataset in etree.iterparse(
+            source, tag='dataset', encoding='utf-8'):
+        dataset_id = '%s/%s' % (
+            dataset.get('datasetID'),
+            dataset.get(XML_LANG)
+        )
+        for url in dataset.iterfind('resource/url'):
+            yield url.text, dataset_id
+        dataset.clear()
+
+
+def write_report(results, path):
+    '''
+    Writes the results as JSON (for a .json path) or CSV, replacing the
+    report only once it is complete
+    '''
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as report:
+        if path.endswith('.json'):
+            json.dump({
+                'checked': datetime.datetime.now().isoformat(),
+                'urls': len(results),
+                'missing': len([r for r in results if not r['available']]),
+                'results': results
+            }, report, indent=2)
+        else:
+            writer = csv.DictWriter(report, LinkChecker.FIELDS)
+            writer.writeheader()
+            for result in results:
+                row = dict(result, datasets=' '.join(result['datasets']))
+                writer.writerow(dict(
+                    (key, unicode(value).encode('utf-8')
+                     if value is not None else '')
+                    for key, value in row.items()
+                ))
+    os.rename(tmp_path, path)
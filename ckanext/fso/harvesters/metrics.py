@@ -0,0 +1,369 @@
+# coding: utf-8
+
+import os
+import re
+import json
+import time
+import atexit
+import datetime
+import tempfile
+import threading
+from paste.deploy.converters import asbool
+from pylons import config as pylons_config
+
+import logging
+log = logging.getLogger(__name__)
+
+FLUSH_INTERVAL = 30
+PROMETHEUS_PREFIX = 'ckanext_fso_'
+
+
+class Metrics(object):
+    '''
+    Timers and counters of the harvest stages (named after the stage,
+    e.g. gather.parse), saved as a JSON summary per job and process
+
+    While it is disabled, timer() returns a shared no-op timer and incr()
+    returns right away. Metrics are attributed to the job of the last
+    start() call, also those recorded by other threads of the process.
+
+    The summaries are saved when the job changes, every FLUSH_INTERVAL
+    seconds (also while a consumer is idle) and when flush() is called at
+    the end of an import. Only the collector of the current job is kept
+    in memory, the collected metrics of a job taken up again are read
+    back from its summary.
+    '''
+
+    def __init__(self):
+        self.enabled = False
+        self.directory = None
+        self.textfile = None
+        self._collectors = {}
+        self._current = None
+        self._dirty = set()
+        self._flushed = time.time()
+        self._flusher_pid = None
+        self._lock = threading.Lock()
+
+    def start(self, job_id, directory, textfile=None):
+        '''
+        Collect the following metrics for the given harvest job
+        '''
+        with self._lock:
+            if self.enabled and self._current['job_id'] == job_id:
+                return
+            switching = self.enabled
+        if switching:
+            # save the previous job before its collector is dropped
+            self.flush()
+
+        with self._lock:
+            if job_id not in self._collectors:
+                self._collectors[job_id] = _load_collector(directory, job_id)
+            self._current = self._collectors[job_id]
+            self.directory = directory
+            self.textfile = textfile
+            self.enabled = True
+        self._start_flusher()
+
+    def _start_flusher(self):
+        '''
+        Start a thread saving the metrics periodically, once per process
+        (threads do not survive a fork)
+        '''
+        if self._flusher_pid == os.getpid():
+            return
+        self._flusher_pid = os.getpid()
+        thread = threading.Thread(target=self._flush_periodically)
+        thread.daemon = True
+        thread.start()
+
+    def _flush_periodically(self):
+        pid = os.getpid()
+        while self._flusher_pid == pid:
+            time.sleep(FLUSH_INTERVAL)
+            if self.enabled:
+                self.flush()
+
+    def stop(self):
+        '''
+        Save all collected metrics and stop collecting
+        '''
+        if self.enabled:
+            self.flush()
+        with self._lock:
+            self.enabled = False
+            self._collectors = {}
+            self._current = None
+            self._flusher_pid = None
+
+    def incr(self, name, value=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._current is None:
+                return
+            counters = self._current['counters']
+            counters[name] = counters.get(name, 0) + value
+            self._dirty.add(self._current['job_id'])
+
+    def timer(self, name):
+        '''
+        Returns a context manager recording the time spent in its block
+        '''
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name)
+
+    def timed_iter(self, name, iterable):
+        '''
+        Wraps an iterable, recording the time spent to get each item
+        '''
+        if not self.enabled:
+            return iterable
+        return self._timed_iter(name, iterable)
+
+    def _timed_iter(self, name, iterable):
+        iterator = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.record(name, time.time() - start)
+                return
+            self.record(name, time.time() - start)
+            yield item
+
+    def record(self, name, seconds):
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._current is None:
+                return
+            timers = self._current['timers']
+            count, total, maximum = timers.get(name, (0, 0.0, 0.0))
+            timers[name] = (count + 1, total + seconds, max(maximum, seconds))
+            self._dirty.add(self._current['job_id'])
+
+    def maybe_flush(self):
+        '''
+        Save the collected metrics at most every FLUSH_INTERVAL seconds
+        '''
+        if self.enabled and time.time() - self._flushed > FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        '''
+        Save the summaries of the changed collectors and update the
+        Prometheus textfile with the current job
+        '''
+        with self._lock:
+            summaries = [
+                _summary(self._collectors[job_id]) for job_id in self._dirty
+            ]
+            self._dirty = set()
+            self._flushed = time.time()
+            current_job = self._current and self._current['job_id']
+            # the other jobs are saved now, drop their collectors
+            for job_id in self._collectors.keys():
+                if job_id != current_job:
+                    del self._collectors[job_id]
+        if not summaries or not self.directory:
+            return
+        try:
+            for summary in summaries:
+                _write(
+                    summary_path(
+                        self.directory,
+                        summary['job_id'],
+                        summary['pid']
+                    ),
+                    json.dumps(summary, indent=2, sort_keys=True)
+                )
+            if self.textfile and current_job:
+                job_summary = merge_summaries(
+                    load_summaries(self.directory, current_job)
+                )
+                _write(self.textfile, prometheus_text(job_summary))
+        except (IOError, OSError), e:
+            log.warning('Unable to save the harvest metrics: %r' % e)
+
+
+class _Timer(object):
+    __slots__ = ['metrics', 'name', 'start']
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.record(self.name, time.time() - self.start)
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def _summary(collector):
+    return {
+        'job_id': collector['job_id'],
+        'pid': collector['pid'],
+        'updated': datetime.datetime.now().isoformat(),
+        'counters': dict(collector['counters']),
+        'timers': dict(
+            (name, {'count': count, 'seconds': total, 'max': maximum})
+            for name, (count, total, maximum)
+            in collector['timers'].items()
+        )
+    }
+
+
+def _load_collector(directory, job_id):
+    '''
+    Returns a collector for a harvest job, with the metrics this process
+    saved for the job already
+    '''
+    collector = {
+        'job_id': job_id,
+        'pid': os.getpid(),
+        'counters': {},
+        'timers': {}
+    }
+    path = summary_path(directory, job_id, os.getpid())
+    if os.path.exists(path):
+        try:
+            with open(path) as summary_file:
+                summary = json.load(summary_file)
+        except (IOError, ValueError), e:
+            log.warning('Ignoring the metrics in %s: %r' % (path, e))
+            return collector
+        collector['counters'] = summary['counters']
+        collector['timers'] = dict(
+            (name, (timer['count'], timer['seconds'], timer['max']))
+            for name, timer in summary['timers'].items()
+        )
+    return collector
+
+
+def _write(path, content):
+    '''
+    Replace a file atomically, readers never see a partial file
+    '''
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'w') as tmp_file:
+        tmp_file.write(content)
+    os.rename(tmp_path, path)
+
+
+def metrics_settings():
+    '''
+    Returns whether metrics are collected (ckanext.fso.metrics), the
+    directory of the summaries (ckanext.fso.metrics_dir) and the path of
+    the Prometheus textfile (ckanext.fso.metrics_textfile)
+    '''
+    directory = pylons_config.get('ckanext.fso.metrics_dir')
+    if not directory:
+        directory = os.path.join(
+            pylons_config.get('cache_dir', tempfile.gettempdir()),
+            'fso_metrics'
+        )
+    return (
+        asbool(pylons_config.get('ckanext.fso.metrics', False)),
+        directory,
+        pylons_config.get('ckanext.fso.metrics_textfile')
+    )
+
+
+def summary_path(directory, job_id, pid):
+    return os.path.join(directory, job_id, '%d.json' % pid)
+
+
+def load_summaries(directory, job_id):
+    '''
+    Returns the summaries saved by all processes for a harvest job
+    '''
+    job_directory = os.path.join(directory, job_id)
+    if not os.path.isdir(job_directory):
+        return []
+    summaries = []
+    for file_name in sorted(os.listdir(job_directory)):
+        if not file_name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(job_directory, file_name)) as summary:
+                summaries.append(json.load(summary))
+        except ValueError:
+            log.warning('Ignoring invalid metrics file %s' % file_name)
+    return summaries
+
+
+def merge_summaries(summaries):
+    '''
+    Adds up the summaries of all processes of a harvest job
+    '''
+    merged = {
+        'job_id': summaries[0]['job_id'] if summaries else None,
+        'processes': len(summaries),
+        'updated': None,
+        'counters': {},
+        'timers': {}
+    }
+    for summary in summaries:
+        merged['updated'] = max(merged['updated'], summary['updated'])
+        counters = merged['counters']
+        for name, value in summary['counters'].items():
+            counters[name] = counters.get(name, 0) + value
+        for name, timer in summary['timers'].items():
+            total = merged['timers'].setdefault(
+                name,
+                {'count': 0, 'seconds': 0.0, 'max': 0.0}
+            )
+            total['count'] += timer['count']
+            total['seconds'] += timer['seconds']
+            total['max'] = max(total['max'], timer['max'])
+    return merged
+
+
+def prometheus_text(job_summary):
+    '''
+    Returns a merged job summary in the Prometheus text format (for the
+    textfile collector of the node exporter)
+    '''
+    labels = '{job_id="%s"}' % job_summary['job_id']
+    samples = []
+    for name, value in job_summary['counters'].items():
+        samples.append((_metric_name(name) + '_total', 'counter', value))
+    for name, timer in job_summary['timers'].items():
+        metric = _metric_name(name) + '_seconds'
+        samples.append((metric + '_count', 'counter', timer['count']))
+        samples.append((metric + '_sum', 'counter', timer['seconds']))
+        samples.append((metric + '_max', 'gauge', timer['max']))
+
+    lines = []
+    for metric, metric_type, value in sorted(samples):
+        lines.append('# TYPE %s %s' % (metric, metric_type))
+        lines.append('%s%s %r' % (metric, labels, float(value)))
+    return '\n'.join(lines) + '\n'
+
+
+def _metric_name(name):
+    return PROMETHEUS_PREFIX + re.sub('[^a-zA-Z0-9_]', '_', name)
+
+
+metrics = Metrics()
+atexit.register(metrics.stop)
@@ -0,0 +1,31 @@
+# coding: utf-8
+
+import base64
+import zlib
+
+from ckan.lib.helpers import json
+
+# prefix of compressed contents, the number is the format version
+ZLIB_MARKER = 'fso-zlib:1:'
+
+
+def encode_content(data, compress=False):
+    '''
+    Serialise the content of a harvest object, optionally as zlib
+    compressed JSON (base64 encoded, as the content column is text)
+    '''
+    content = json.dumps(data)
+    if not compress:
+        return content
+    return ZLIB_MARKER + base64.b64encode(zlib.compress(content, 9))
+
+
+def decode_content(content):
+    '''
+    Deserialise the content of a harvest object, which can be plain or
+    compressed JSON
+    '''
+    if content.startswith(ZLIB_MARKER):
+        compressed = base64.b64decode(content[len(ZLIB_MARKER):])
+        content = zlib.decompress(compressed)
+    return json.loads(content)
@@ -0,0 +1,146 @@
+# coding: utf-8
+
+import Queue
+import threading
+import time
+from urlparse import urlparse
+
+from cache import CacheError
+from metrics import metrics
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class ResourceProber(object):
+    '''
+    Checks the availability of a batch of URLs concurrently
+
+    The number of requests in flight is bounded by `workers` in total
+    and by `per_host` for every single host. With `rate`, at most that
+    many requests per second are started for every single host.
+    '''
+
+    def __init__(self, check, workers=8, per_host=4, rate=None):
+        self.check = check
+        self.workers = max(1, int(workers))
+        self.per_host = max(1, int(per_host))
+        self.rate = float(rate) if rate else None
+        self._host_semaphores = {}
+        self._next_requests = {}
+        self._lock = threading.Lock()
+
+    def _host_semaphore(self, url):
+        '''
+        Return the semaphore limiting the requests to the host of url
+        '''
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._host_semaphores:
+                self._host_semaphores[host] = threading.BoundedSemaphore(
+                    self.per_host
+                )
+            return self._host_semaphores[host]
+
+    def _throttle(self, url):
+        '''
+        Wait until the rate limit allows the next request to the host
+        of url
+        '''
+        if not self.rate:
+            return
+        host = urlparse(url).netloc
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next_requests.get(host, now))
+            self._next_requests[host] = start + 1.0 / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+    def _work(self, queue, results):
+        while True:
+            try:
+                url = queue.get_nowait()
+            except Queue.Empty:
+                return
+            with self._host_semaphore(url):
+                self._throttle(url)
+                try:
+                    results[url] = self.check(url)
+                except Exception, e:
+                    log.debug('Probing %s failed: %r' % (url, e))
+                    results[url] = False
+
+    def probe(self, urls):
+        '''
+        Return a dict with the availability (True/False) of every URL
+        '''
+        queue = Queue.Queue()
+        for url in set(url for url in urls if url):
+            queue.put(url)
+
+        results = {}
+        threads = [
+            threading.Thread(target=self._work, args=(queue, results))
+            for _ in range(min(self.workers, queue.qsize()))
+        ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        log.debug(
+            '%d of %d resources are available'
+            % (sum(results.values()), len(results))
+        )
+        return results
+
+
+def head_status(url, client, cache=None):
+    '''
+    Returns the status of a HEAD request to url and whether it was taken
+    from the availability cache
+
+    Fresh results are taken from the cache, expired ones are revalidated
+    with a conditional request. If the cache cannot be used, the URL is
+    checked as if it was not cached.
+    '''
+    entry = None
+    if cache:
+        try:
+            entry = cache.get(url)
+        except CacheError, e:
+            log.warning('Availability cache lookup failed: %r' % e)
+    if entry and entry['fresh']:
+        metrics.incr('head.cached')
+        return entry['status'], True
+
+    headers = {}
+    if entry and entry['etag']:
+        headers['If-None-Match'] = entry['etag']
+    if entry and entry['last_modified']:
+        headers['If-Modified-Since'] = entry['last_modified']
+    with metrics.timer('head.request'):
+        response = client.request('HEAD', url, headers=headers)
+    status = response.status
+    metrics.incr('head.status.%s' % status)
+    if entry and status == 304:
+        _update_cache(cache.revalidated, url)
+        return entry['status'], False
+    if cache:
+        _update_cache(
+            cache.set,
+            url,
+            status,
+            response.getheader('etag'),
+            response.getheader('last-modified')
+        )
+    return status, False
+
+
+def _update_cache(method, *args):
+    try:
+        method(*args)
+    except CacheError, e:
+        log.warning('Unable to update the availability cache: %r' % e)
@@ -0,0 +1,65 @@
+# coding: utf-8
+
+XML_LANG = '{http://www.w3.org/XML/1998/namespace}lang'
+
+
+class DatasetRecord(object):
+    '''
+    The values of a <dataset> element (one language variant of a
+    package), extracted once so that the XML tree can be released early
+    '''
+
+    FIELDS = [
+        'title', 'author', 'maintainer', 'maintainer_email', 'notes',
+        'coverage', 'published', 'licence', 'copyright'
+    ]
+    __slots__ = [
+        'dataset_id', 'lang', 'group_codes', 'tags', 'resource_url',
+        'resource_name'
+    ] + FIELDS
+
+    def __init__(self, dataset):
+        self.dataset_id = dataset.get('datasetID')
+        self.lang = dataset.get(XML_LANG)
+        for field in self.FIELDS:
+            setattr(self, field, _text(dataset, field))
+        self.group_codes = [
+            (group.text or '')[0:2]
+            for group in dataset.iterfind('groups/group')
+        ]
+        self.tags = [tag.text for tag in dataset.iterfind('tags/tag')]
+        self.resource_url = _text(dataset, 'resource/url')
+        self.resource_name = _text(dataset, 'resource/name')
+
+    @property
+    def group_prefix(self):
+        '''
+        The first two digits of the first group of the dataset
+        '''
+        if self.group_codes:
+            return self.group_codes[0]
+        return None
+
+
+def package_records(package):
+    '''
+    Returns the base record (the german dataset if one is available,
+    otherwise the first one) and the records of all datasets of a
+    <package> element
+    '''
+    records = [
+        DatasetRecord(dataset) for dataset in package.iterfind('dataset')
+    ]
+    if not records:
+        return None, records
+    for record in records:
+        if record.lang == 'de':
+            return record, records
+    return records[0], records
+
+
+def _text(element, path):
+    child = element.find(path)
+    if child is None:
+        return None
+    return child.text